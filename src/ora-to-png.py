@@ -71,6 +71,9 @@ def img_to_np(fp):
         reads an image from the file handle and returns it as an numpy array
     """
     img = Image.open(fp)
+    if img.mode in ["P", "PA"]:
+        # indexed layers are expanded by a palette lookup in Pillow
+        img = img.convert("RGBA")
     imga = np.asarray(img)
     return npa_convert_to_rgba(imga)
     
@@ -81,6 +84,125 @@ def coerce_to_list(x):
     return [x]
 
 
+class Layer:
+    """
+        a layer of an image: its name, its pixels together with their offset
+        on the canvas, opacity and visibility.
+
+        The pixels are usually cropped to their bounding box, and size (w,h)
+        is the area from the canvas origin that the layer spans including
+        the transparent margins, i.e. the shape of the uncropped layer.
+    """
+    __slots__ = ["name", "array", "x", "y", "opacity", "visible", "size"]
+
+    def __init__(self, name, array, x=0, y=0, opacity=1.0, visible=True, size=(0,0)):
+        self.name = name
+        self.array = array
+        self.x = x
+        self.y = y
+        self.opacity = opacity
+        self.visible = visible
+        self.size = size
+
+    def pixels(self):
+        return self.array
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+class Document:
+    """
+        the layer stack of an image.
+
+        Layers are held bottom to top in an insertion ordered dict, so they
+        are put on top of the stack and removed in constant time, and the
+        keys of the other layers stay the same meanwhile.
+    """
+    __slots__ = ["layers", "next_key"]
+
+    def __init__(self, layers=[]):
+        """ layers are given from top to bottom """
+        self.layers = {}
+        self.next_key = 0
+        for layer in reversed(layers):
+            self.add(layer)
+
+    def add(self, layer):
+        """ puts the layer on top of the stack and returns its key """
+        key = self.next_key
+        self.next_key += 1
+        self.layers[key] = layer
+        return key
+
+    def remove(self, key):
+        del self.layers[key]
+
+    def __getitem__(self, key):
+        return self.layers[key]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        """ iterates over the layers from top to bottom """
+        return reversed(self.layers.values())
+
+    def top_down(self):
+        """ returns (key, position counted from the bottom, layer) from top to bottom """
+        n = len(self.layers)
+        return [(key, n-nbr-1, layer) for nbr,(key,layer) in enumerate(reversed(self.layers.items()))]
+
+def get_pixels(img):
+    """
+        returns the pixel array of a layer or pixel array
+    """
+    if isinstance(img, Layer):
+        return img.pixels()
+    return img
+
+def layer_attributes(img):
+    """
+        returns (x, y, opacity, visible) of a layer or pixel array
+    """
+    if isinstance(img, Layer):
+        return img.x, img.y, img.opacity, img.visible
+    return 0, 0, 1.0, True
+
+def placement(img):
+    """
+        returns (pixels, x, y, opacity, visible) of a layer or pixel array
+    """
+    return (get_pixels(img),) + layer_attributes(img)
+
+def is_empty(img):
+    """ whether the layer or pixel array has no pixels at all """
+    shape = img.shape
+    return shape[0] == 0 or shape[1] == 0
+
+def extent(img):
+    """
+        returns the size (w,h) of the area from the canvas origin that the
+        layer or pixel array spans
+    """
+    shape = img.shape
+    if isinstance(img, Layer):
+        if is_empty(img):
+            return img.size
+        return max(img.size[0], img.x + shape[1]), max(img.size[1], img.y + shape[0])
+    return shape[1], shape[0]
+
+def canvas_size(imgs, size=None):
+    """
+        returns the size (w,h) of a canvas that is at least size and holds
+        all given layers
+    """
+    w, h = size if size is not None else (0, 0)
+    for img in imgs:
+        w0, h0 = extent(img)
+        w, h = max(w, w0), max(h, h0)
+    return w, h
+
 def load_ora(path):
     """
         Loads an Open Raster image; as it might have been saved by krita or pinta...
@@ -91,9 +213,12 @@ def load_ora(path):
         if 'stack.xml' not in files:
             return None
         info = xmltodict.parse(f.read('stack.xml'))
-        layer_names_srcs = list(map(lambda x: (x['@name'],x['@src']), coerce_to_list(info['image']['stack']['layer'])))
-        layers = [ (lbl, img_to_np(f.open(src))) for lbl,src in layer_names_srcs]
-    return layers
+        # each layer spans the whole canvas, but may be stored cropped
+        size = (int(info['image'].get('@w',0)), int(info['image'].get('@h',0)))
+        for x in coerce_to_list(info['image']['stack']['layer']):
+            layers.append(Layer(x['@name'], img_to_np(f.open(x['@src'])), int(x.get('@x',0)), int(x.get('@y',0)),
+                                float(x.get('@opacity',1)), x.get('@visibility','visible') != 'hidden', size))
+    return Document(layers)
         
 def get_matcher_from_str(exp):
     """
@@ -135,7 +260,7 @@ def get_layer_filter_map(filter_exp):
         return filter_exp
     if type(filter_exp) == list:
         q = [get_layer_filter_map(x) for x in filter_exp]
-        return lambda x,y,q=q: any([f(x,y) for f in q])
+        return lambda x,y,q=q: any(f(x,y) for f in q)
     if type(filter_exp) == str:
         q = get_matcher_from_str(filter_exp)
         return lambda x,y,q=q: q(y)
@@ -145,28 +270,110 @@ def get_layer_filter_map(filter_exp):
 def get_layers(image, layers):
     img_layer = []
     layer_filter = get_layer_filter_map(layers)
-    for nbr,l in enumerate(image):
-        name, imgl = l
-        if layer_filter(len(image)-nbr-1,name):
-            img_layer.append(imgl)
+    for _,pos,layer in image.top_down():
+        if layer_filter(pos,layer.name):
+            img_layer.append(layer)
     return img_layer
     
-def merge_layers(layers):
-    """
-        merges a list of pixel arrays and returns the result as
-        RGBA array
-    """
-    layers = [x if len(x.shape) == 3 and x.shape[-1] == 4 else npa_convert_to_rgba(x) for x in layers ] 
-    w = max(map(lambda x: x.shape[1], layers))
-    h = max(map(lambda x: x.shape[0], layers))
-    output = np.zeros((h,w,4),dtype=np.float)
-    for l in layers:
-        h,w = l.shape[:2]
-        opaqueness = output[0:h,0:w,-1:]
-        see_through_left = 255 - opaqueness
-        output[0:h,0:w,:-1] = (opaqueness * output[0:h,0:w,:-1] + see_through_left * l[0:h,0:w,:-1]) / 255
-        output[0:h,0:w,-1:] = opaqueness + see_through_left * l[0:h,0:w,-1:] / 255
-    return (output + .5).astype(np.uint8)
+# layers are blended in horizontal strips of about this many pixels, which
+# bounds the size of the temporary arrays
+composite_strip_pixels = 1 << 18
+
+# composites are held in fixed point: each channel value v is stored as
+# v*256 in an uint16, so fx_opaque is the alpha value of opaque pixels
+fx_opaque = 255 << 8
+
+def blend_strip(state, l, opacity=255):
+    """
+        blends the RGBA pixel array l with the given opacity (0..255) below
+        the fixed point composite state of the same size; transparent pixels
+        of l leave the composite as it is, so blending a layer does not
+        depend on how far it is cropped
+    """
+    alpha = state[:,:,3:].astype(np.uint32)
+    if alpha.min() == fx_opaque:
+        # nothing below an opaque composite shows through
+        return
+    l_alpha = layer_alpha(l, opacity)
+    shows = l_alpha != 0
+    if not shows.any():
+        return
+    see_through = fx_opaque - alpha
+    l = l.astype(np.uint32)
+    # at most fx_opaque*fx_opaque + fx_opaque//2 < 2**32
+    color = alpha * state[:,:,:-1] + see_through * (l[:,:,:-1] << 8)
+    np.copyto(state[:,:,:-1], (color + fx_opaque//2) // fx_opaque, casting="unsafe", where=shows)
+    state[:,:,-1:] = alpha + (see_through * l_alpha + 127) // 255
+
+def layer_alpha(l, opacity=255):
+    """ returns the alpha channel of l scaled by the opacity (0..255) """
+    alpha = l[:,:,-1:].astype(np.uint32)
+    if opacity != 255:
+        alpha = (alpha * opacity + 127) // 255
+    return alpha
+
+def layer_placements(layers):
+    """
+        returns (pixels, x, y, opacity) of the visible, non-empty layers,
+        where the pixels are RGBA arrays and the opacity is in 0..255
+    """
+    placed = []
+    for img in layers:
+        x, y, opacity, visible = layer_attributes(img)
+        if not visible or is_empty(img):
+            continue
+        l = get_pixels(img)
+        if not (len(l.shape) == 3 and l.shape[-1] == 4):
+            l = npa_convert_to_rgba(l)
+        placed.append((l, x, y, min(max(int(opacity*255+.5),0),255)))
+    return placed
+
+def blend_layers(layers, state, x0, y0, empty=False):
+    """
+        blends the placed layers below the fixed point composite state of the
+        canvas area that starts at (x0,y0); only the areas that are covered
+        by a layer take part in blending
+    """
+    h,w = state.shape[:2]
+    for l, x, y, opacity in layers:
+        top, bottom = max(y, y0), min(y+l.shape[0], y0+h)
+        left, right = max(x, x0), min(x+l.shape[1], x0+w)
+        if top >= bottom or left >= right:
+            continue
+        l = l[top-y:bottom-y, left-x:right-x]
+        area = state[top-y0:bottom-y0, left-x0:right-x0]
+        if empty:
+            # blending onto a transparent black canvas copies the layer
+            # except for the color of its transparent pixels
+            alpha = layer_alpha(l, opacity)
+            area[:,:,:-1] = l[:,:,:-1].astype(np.uint16) << 8
+            area[:,:,:-1] *= alpha != 0
+            area[:,:,-1:] = alpha << 8
+            empty = False
+        else:
+            blend_strip(area, l, opacity)
+
+def fx_to_uint8(state):
+    """ rounds a fixed point composite to an RGBA array """
+    return ((state + 128) >> 8).astype(np.uint8)
+
+def merge_layers(layers, area=None):
+    """
+        merges a list of layers or pixel arrays and returns the result as
+        RGBA array; area (x,y,w,h) is the part of the canvas that is
+        returned, and defaults to the canvas that holds all layers
+    """
+    if area is None:
+        area = (0, 0) + canvas_size(layers)
+    x0, y0, w, h = area
+    placed = layer_placements(layers)
+    output = np.empty((h,w,4),dtype=np.uint8)
+    rows = max(1, composite_strip_pixels // max(w,1))
+    for s0 in range(0, h, rows):
+        state = np.zeros((min(rows,h-s0),w,4),dtype=np.uint16)
+        blend_layers(placed, state, x0, y0+s0, empty=True)
+        output[s0:s0+rows] = fx_to_uint8(state)
+    return output
 
     
 ### HERE WE GO ###
@@ -21,6 +21,22 @@ echo ""
 ./ora-tool.py help yaml
 echo "\`\`\`"
 
+echo "### benchmarks"
+echo ""
+echo "\`\`\`"
+echo "> ./ora-tool.py help benchmark"
+echo ""
+./ora-tool.py help benchmark
+echo "\`\`\`"
+
+echo "### global options"
+echo ""
+echo "\`\`\`"
+echo "> ./ora-tool.py help options"
+echo ""
+./ora-tool.py help options
+echo "\`\`\`"
+
 echo "### available operations"
 echo ""
 echo "\`\`\`"
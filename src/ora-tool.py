@@ -3,9 +3,20 @@
 import sys
 import os
 import zipfile
+import io
 import re
+import contextlib
+import traceback
+import heapq
+import multiprocessing
 
-import colorsys
+import hashlib
+import json
+import tempfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import OrderedDict
 
 
 # non-standard python modules
@@ -15,14 +26,17 @@ try:
     import numpy as np
     import yaml
     from skimage import transform as sit
+    from scipy import spatial
 except ModuleNotFoundError:
     print("One or more required packages are missing. Try running:")
-    print("   python3 -m pip install --user xmltodict Pillow numpy pyyaml scikit-image")
+    print("   python3 -m pip install --user xmltodict Pillow numpy pyyaml scikit-image scipy")
     sys.exit(1)
     
 # We support different modes of programming this tool
 
-supported_modes = ["yaml","binarize","palettize","pal-bin"]
+supported_modes = ["yaml","binarize","palettize","pal-bin","benchmark"]
+
+benchmark_list = ["palette-index"]
 
 
 oplist = sorted(["to-nearest-palette",
@@ -81,6 +95,14 @@ palette_description = """
     as an array of 4-elementary arrays (RGBA), or as a string refering to a
     predefined palette. Valid predefined palettes are:
             ega
+    Furthermore, the string may be the name (without extension) or the path
+    of a palette file in one of the following formats:
+            .txt    paint.net palette, one aarrggbb hex value per line
+            .gpl    GIMP palette
+            .pal    JASC palette
+    Palette files are searched for in the directories of the palette-path
+    option (see: help options) and in the palettes directory of this tool.
+    Palettes with transparent colors are used as RGBA palettes.
 """
 
 # to-nearest-palette
@@ -90,7 +112,9 @@ default_params["to-nearest-palette"] = {
     "layers":"+@.*",
     "palette":"ega",
     "colorspace":"rgb",
-    "divisor":255
+    "divisor":255,
+    "method":"unique",
+    "lut-bits":8
     }
 
 op_help["to-nearest-palette"] = """
@@ -107,7 +131,16 @@ param_help["to-nearest-palette"] = {
     "layers":layers_description,
     "palette":palette_description,
     "colorspace":"Space where distance is measured, one of: rgb, hls, hsv, yiq.",
-    "divisor":"\nThe difference between each original color channel and each\npalette color channel is divided by this value.\n"
+    "divisor":"\nThe difference between each original color channel and each\npalette color channel is divided by this value.\n",
+    "method":"\nHow the nearest colors are searched, one of:\n"+
+             "  unique: only the distinct colors of a layer are looked up, and the\n"+
+             "          results are remembered for later layers and tasks.\n"+
+             "  pixels: every pixel is looked up on its own.\n"+
+             "  lut:    (RGB palettes only) the palette is compiled into a lookup table\n"+
+             "          from quantized RGB values to palette colors once, which is\n"+
+             "          stored below the cache-dir option, see: help options.\n",
+    "lut-bits":"\n(lut method only) number of bits per channel of the lookup table, 1-8;\n"+
+               "with less than 8 bits, colors are quantized before the look up.\n"
 }
 
 # to-binary-alpha
@@ -140,19 +173,22 @@ default_params["fix-transparent-color"] = {
     "layers":"!~backdrop",
     "threshold": 0,
     "neighborhood": 8,
+    "iterations": 1,
     }
     
 op_help["fix-transparent-color"] = """
     The color channel of transparent pixels is set to the weighted sum of their 
     neighboring non-transparent pixels, where the weighting occurs with respect
-    to the alpha channel.
+    to the alpha channel. Further iterations bleed these colors outward by one
+    more pixel each, averaging the pixels set in the previous iteration.
 """
 
 param_help["fix-transparent-color"] = {
     "images":images_description,
     "layers":layers_description,
     "threshold":"\nThreshold value for the alpha component, below this value,\na pixel is considered to be transparent.\n",
-    "neighborhood":"\nEither 8 for all neighboring cells or 4 for the cross neightbors.\n"
+    "neighborhood":"\nEither 8 for all neighboring cells or 4 for the cross neightbors.\n",
+    "iterations":"\nNumber of pixels the colors are bled outward into the transparent area.\n",
 }
 
 # add-tileset-spaces
@@ -259,6 +295,12 @@ default_params["rotate-layers"] = {
 
 op_help["rotate-layers"] = """
     Rotates the matching layers in the images in memory.
+    Consecutive rotations, flips, moves and resizes of a
+    layer are combined, so that the layer is resampled
+    only once, unless their order, mode, cval or clip
+    parameters differ. Rotations by multiples of 90
+    degrees copy the pixels exactly, whereas resampling
+    may round channel values down by one.
 """
 
 param_help["rotate-layers"] = {
@@ -301,7 +343,8 @@ default_params["merge-layers"] = {
 op_help["merge-layers"] = """
     Merges the matching layers in the images in memory,
     puts the merged layer on top of the respective image,
-    and removes the source layers.
+    and removes the source layers. Hidden source layers
+    do not contribute to the merged layer.
 """
 
 param_help["merge-layers"] = {
@@ -351,6 +394,11 @@ op_help["resize-layers"] = """
     by either adding rows/cols of transparent pixels,
     or removing rows/cols of image pixels (crop mode);
     or by interpolation (interpolation mode).
+    Without anti-aliasing, interpolation is combined with
+    other transformations of the layer like rotate-layers.
+    Scaling by integer factors copies the pixels exactly
+    for order 0, and shrinking does for order 1, whereas
+    resampling may round channel values down by one.
 """
 
 param_help["resize-layers"] = {
@@ -367,15 +415,79 @@ param_help["resize-layers"] = {
     "order":"(interpolation mode only) order of the spline interpolation, may be 0-5."
 }
 
+# global options
+
+default_options = {
+    "cache-dir": "~/.cache/ora-tool",
+    "palette-path": "",
+    "layer-format": "rgba",
+    "workers": 0,
+    "explain": False,
+    "layer-cache-size": 0,
+    "manifest": "",
+    "jobs": 1,
+}
 
+option_help = {
+    "cache-dir":"\nDirectory where compiled palette lookup tables and decoded layers are stored.\n",
+    "palette-path":f"\nDirectories where palette files are searched for, separated by '{os.pathsep}',\nbefore the palettes directory of this tool is searched.\n",
+    "layer-format":"\nHow the layers of written files are stored, one of:\n"+
+                   "  rgba:    32 bit RGBA png images.\n"+
+                   "  indexed: paletted png images with transparency for layers with\n"+
+                   "           at most 256 distinct colors (e.g. after to-nearest-palette),\n"+
+                   "           and 32 bit RGBA png images for all other layers.\n",
+    "workers":"\nNumber of threads that decode and encode the png images of layers in\nparallel; 0 uses one thread per cpu core. When several jobs run, each\nprocess uses at most its share of the cpu cores.\n",
+    "explain":"\nFlag, print how the ops of each task are carried out instead of running\n"+
+              "them: adjacent per pixel ops on the same layers are fused into a single\n"+
+              "pass, and layers that a later rm-layers removes are skipped.\n",
+    "layer-cache-size":"\nSize limit in megabytes of the decoded layers of OpenRaster files that\n"+
+                       "are kept below the cache-dir, so that the layer png images of unchanged\n"+
+                       "input files are not decoded again; the least recently used layers are\n"+
+                       "removed first. 0 disables the cache.\n",
+    "manifest":"\nPath of the build manifest, which records a hash of the ops, options and\n"+
+               "input files of each task, and the files it has written. Tasks whose hash\n"+
+               "is unchanged since their last run are skipped as long as their output\n"+
+               "files are intact. Empty runs all tasks.\n"+
+               "With several jobs, the tasks of a chain after the first one are run\n"+
+               "along with it without checking them, since they read files that have\n"+
+               "just been written, see jobs.\n",
+    "jobs":"\nNumber of tasks that are run in parallel by separate processes; a task\n"+
+           "waits for the tasks before it that write files it reads or writes, and\n"+
+           "for those that read files it writes. The output of each task is printed\n"+
+           "once it is done. 0 uses one process per cpu core.\n"+
+           "Images that a task stores for later tasks are handed over to them in\n"+
+           "memory, and encoded and written to their files in the background. This\n"+
+           "requires them to run in the same process, so a chain of tasks that each\n"+
+           "read the files of the one before runs as a single job.\n",
+}
 
+# options may be given anywhere on the command line as '--option value';
+# flags, i.e. options with a boolean default, do not take a value.
+options = default_options.copy()
+args = [sys.argv[0]]
+nbr = 1
+while nbr < len(sys.argv):
+    arg = sys.argv[nbr]
+    if arg.startswith("--") and arg[2:] in default_options:
+        if type(default_options[arg[2:]]) == bool:
+            options[arg[2:]] = True
+        elif nbr + 1 < len(sys.argv):
+            nbr += 1
+            options[arg[2:]] = sys.argv[nbr]
+        else:
+            print(f"WARNING: ignoring option {arg} without value.")
+    else:
+        args.append(arg)
+    nbr += 1
+sys.argv = args
 
 
 if len(sys.argv) > 1 and sys.argv[1] == "help":
-    if len(sys.argv) < 3 or not sys.argv[2] in supported_modes+["ops","op","parameter"]:
-        print(f"Usage: {sys.argv[0]} help [MODE|ops]")
+    if len(sys.argv) < 3 or not sys.argv[2] in supported_modes+["ops","op","parameter","options"]:
+        print(f"Usage: {sys.argv[0]} help [MODE|ops|options]")
         print(f" where MODE may be one of the following:\n\n {', '.join(supported_modes)}")
         print(f"\nYou may use   {sys.argv[0]} help ops    to get more information on available operations.")
+        print(f"\nYou may use   {sys.argv[0]} help options    to get more information on global options.")
     else:
         mode = sys.argv[2]
         if mode == "ops":
@@ -437,6 +549,26 @@ if len(sys.argv) > 1 and sys.argv[1] == "help":
             print("maps to a map of parameters that override the operations defaults.")
             print(f"You may use \n    {sys.argv[0]} help ops \nin order to obtain a list of supported operations.")
             
+        elif mode == "benchmark":
+            print(f"Usage: {sys.argv[0]} benchmark [benchmark-names]")
+            print(" where [benchmark-names] may be a sequence of the following benchmarks:")
+            print("        "+"\n        ".join(benchmark_list))
+            print(" If the sequence is empty, then all benchmarks are run.\n")
+            print("The benchmarks time alternative implementations of the same operation")
+            print("on random data, so that the thresholds where the tool switches between")
+            print("them can be checked on the machine at hand.")
+            
+        elif mode == "options":
+            print(f"Usage: {sys.argv[0]} MODE [--option value] [...]")
+            print(" where --option may be one of the following:")
+            for name in sorted(default_options):
+                print(f"\n--{name}")
+                print(option_help[name])
+                print("default: ")
+                print("     "+yaml.dump({name:default_options[name]},default_flow_style = False, allow_unicode = True).replace("\n","\n     "))
+            print("Each map below an 'ora-tool' key in a yaml file may override these options")
+            print("for its task by a key of the same name, e.g. 'cache-dir: /tmp/cache'.")
+            
         else:
             print(f"Unfortunately, the help on {mode} is currently not available.")
     sys.exit(0)
@@ -446,6 +578,7 @@ if len(sys.argv) < 2 or not sys.argv[1] in supported_modes:
     print(f" where MODE may be one of the following:\n  {', '.join(supported_modes)}")
     print(f"\nYou may use   {sys.argv[0]} help MODE   to get more information on each mode.")
     print(f"\nYou may use   {sys.argv[0]} help ops    to get more information on available operations.")
+    print(f"\nYou may use   {sys.argv[0]} help options    to get more information on global options.")
     sys.exit(1)
 
 todo = []
@@ -465,13 +598,17 @@ def find_all_ora_tool_dicts(y):
 
 if sys.argv[1] == "yaml":
     parts = []
-    if len(sys.argv) > 2:
+    if __name__ == "__mp_main__":
+        # worker processes that are spawned import this script again, they
+        # get their tasks and options from run_job
+        pass
+    elif len(sys.argv) > 2:
         for p in sys.argv[2:]:
             with open(p,"r",encoding="utf-8") as fy:
-                for part in yaml.load_all(fy):
+                for part in yaml.safe_load_all(fy):
                     parts.append(part)
     else:
-        for part in yaml.load_all(sys.stdin):
+        for part in yaml.safe_load_all(sys.stdin):
             parts.append(part)
     for part in parts:
         todo.extend(find_all_ora_tool_dicts(part))
@@ -511,6 +648,14 @@ elif sys.argv[1] == "pal-bin":
     todo = [{'input': inpath,
              'output': outpath,
              'ops':['to-nearest-palette','to-binary-alpha','rm-layers']}]
+elif sys.argv[1] == "benchmark":
+    benchmarks = sys.argv[2:]
+    if benchmarks == []:
+        benchmarks = benchmark_list
+    for b in benchmarks:
+        if not b in benchmark_list:
+            print(f"Unknown benchmark {b}; call {sys.argv[0]} help {sys.argv[1]}.")
+            sys.exit(1)
 else:
     print("Mode {sys.argv[1]} currently not available!")
     sys.exit(1)
@@ -536,6 +681,82 @@ ega_palette = np.array([ [int(x[i*2]+x[i*2+1],base=16) for i in range(3)] for x
 
 named_palettes = {'ega': ega_palette}
 
+# further palettes are read from files in these formats, which are found
+# in the palette directories and the directories of the palette-path option
+palette_formats = [".txt", ".gpl", ".pal"]
+palette_dirs = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "palettes"),
+                os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "palettes")]
+
+# directory listings of the palette search paths, name -> file path
+palette_files = {}
+
+# parsed palette files, path -> (mtime, palette)
+palette_registry = {}
+
+def find_palette_file(name, search_path=""):
+    """
+        returns the path of the palette file called name (without extension)
+        in the search path or the palette directories, or None.
+
+        Earlier directories take precedence; each directory is only listed
+        once per process.
+    """
+    dirs = [d for d in str(search_path or "").split(os.pathsep) if d != ""] + palette_dirs
+    key = tuple(dirs)
+    if not key in palette_files:
+        found = {}
+        for d in reversed(dirs):
+            d = os.path.expanduser(d)
+            if not os.path.isdir(d):
+                continue
+            for fname in sorted(os.listdir(d)):
+                stem, ext = os.path.splitext(fname)
+                if ext.lower() in palette_formats:
+                    found[stem] = os.path.join(d, fname)
+        palette_files[key] = found
+    return palette_files[key].get(name)
+
+def parse_palette_file(path):
+    """
+        reads a palette in paint.net (.txt, aarrggbb hex values), GIMP (.gpl)
+        or JASC (.pal) format. Returns an RGB palette, unless some color of the
+        palette is not opaque, in which case an RGBA palette is returned.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        lines = [l.strip() for l in f.read().splitlines()]
+    colors = []
+    if lines and lines[0].startswith("GIMP Palette"):
+        for l in lines[1:]:
+            if l == "" or l.startswith("#") or ":" in l.split()[0]:
+                continue
+            colors.append([int(x) for x in l.split()[:3]] + [255])
+    elif lines and lines[0] == "JASC-PAL":
+        count = int(lines[2])
+        for l in lines[3:3+count]:
+            x = [int(v) for v in l.split()]
+            colors.append(x[:3] + x[3:4] + [255]*(1-len(x[3:4])))
+    else:
+        for l in lines:
+            if l == "" or l.startswith(";"):
+                continue
+            if len(l) == 6:
+                l = "FF" + l
+            colors.append([int(l[i*2:i*2+2], base=16) for i in [1,2,3,0]])
+    palette = np.array(colors, dtype=np.uint8).reshape((-1,4))
+    if (palette[:,3] == 255).all():
+        palette = palette[:,:3]
+    return palette
+
+def load_palette_file(path):
+    """
+        returns the parsed palette of the file, which is only read again when
+        its modification time has changed.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    if not path in palette_registry or palette_registry[path][0] != mtime:
+        palette_registry[path] = (mtime, parse_palette_file(path))
+    return palette_registry[path][1]
+
 
 
 def npa_convert_to_rgba(imga):
@@ -564,6 +785,9 @@ def img_to_np(fp):
         reads an image from the file handle and returns it as an numpy array
     """
     img = Image.open(fp)
+    if img.mode in ["P", "PA"]:
+        # indexed layers are expanded by a palette lookup in Pillow
+        img = img.convert("RGBA")
     imga = np.asarray(img)
     return npa_convert_to_rgba(imga)
 
@@ -572,180 +796,1609 @@ def coerce_to_list(x):
         return x
     return [x]
 
-def load_ora(path):
+# png modes of unmodified layers that are copied to the output without
+# decoding and encoding them again, by layer format
+passthrough_png_modes = {
+    "rgba": ["RGBA", "RGB", "LA", "L", "P", "PA"],
+    "indexed": ["P", "PA"],
+}
+
+# serializes the access to the zip files of lazy layers across threads
+zip_lock = threading.Lock()
+
+class Layer:
+    """
+        a layer of an image: its name, its pixels together with their offset
+        on the canvas, opacity and visibility.
+
+        The pixels are usually cropped to their bounding box, and size (w,h)
+        is the area from the canvas origin that the layer spans including
+        the transparent margins, i.e. the shape of the uncropped layer.
+
+        Layers that are loaded from an OpenRaster file keep their zip entry
+        as source and decode it only when their pixels are needed for the
+        first time; they are dirty once their pixels have been changed.
+
+        Copies of a layer share its pixel array, so the array may only be
+        changed in place if the layer owns it, see writable_pixels.
+
+        Geometric ops put their affine map on the pending transform of the
+        layer, which is applied once when the pixels are needed, see
+        add_transform.
+    """
+    __slots__ = ["name", "array", "x", "y", "opacity", "visible", "size", "dirty", "source", "header", "owned", "transform"]
+
+    def __init__(self, name, array=None, x=0, y=0, opacity=1.0, visible=True, size=(0,0), source=None):
+        self.name = name
+        self.array = array
+        self.x = x
+        self.y = y
+        self.opacity = opacity
+        self.visible = visible
+        self.size = size
+        self.dirty = source is None
+        self.source = source
+        self.header = None
+        self.owned = False
+        self.transform = None
+
+    def copy(self, name=None):
+        """ returns a copy of the layer, that shares the pixel array """
+        layer = Layer(self.name if name is None else name, self.array, self.x, self.y,
+                      self.opacity, self.visible, self.size, self.source)
+        layer.dirty = self.dirty
+        layer.header = self.header
+        layer.transform = self.transform
+        self.owned = False
+        return layer
+
+    def pixels(self):
+        if self.array is None:
+            self.array = decode_source(self.source)
+            # cached layers are memory-mapped read-only
+            self.owned = self.array.flags.writeable
+        if self.transform is not None:
+            apply_transform(self)
+        return self.array
+
+    def writable_pixels(self):
+        """
+            returns the pixel array for changes in place, which is copied
+            first unless it is owned by the layer; the layer becomes dirty
+        """
+        pixels = self.pixels()
+        if not self.owned or not pixels.flags.writeable:
+            self.array = np.copy(pixels)
+            self.owned = True
+        self.dirty = True
+        self.header = None
+        return self.array
+
+    def set_pixels(self, array, x=0, y=0, size=(0,0), owned=False):
+        """
+            replaces the pixels of the layer by array at the offset (x,y),
+            cropped to its bounding box, and the layer spans at least size;
+            owned tells whether the array may be changed in place later on
+        """
+        self.array, self.x, self.y, self.size = crop_pixels(array, x, y, size)
+        self.dirty = True
+        self.header = None
+        self.owned = owned
+
+    def read(self):
+        """ returns the bytes of the source zip entry; zip files are read by one thread at a time """
+        zf, entry = self.source
+        with zip_lock:
+            return zf.read(entry)
+
+    def read_header(self):
+        """ reads (format, mode, size) from the image header of the source zip entry """
+        if self.header is None:
+            zf, entry = self.source
+            with zip_lock:
+                with zf.open(entry) as fp:
+                    img = Image.open(fp)
+                    self.header = (img.format, img.mode, img.size)
+        return self.header
+
+    @property
+    def shape(self):
+        """ shape of the pixel array; only the png header is read if possible """
+        if self.transform is not None:
+            return self.pixels().shape
+        if self.array is not None:
+            return self.array.shape
+        size = self.read_header()[2]
+        return (size[1], size[0], 4)
+
+    def png_bytes(self, layer_format="rgba"):
+        """
+            returns the original png file of an unchanged layer if it may be
+            copied to an output file in the given layer format as it is,
+            or None
+        """
+        if self.dirty:
+            return None
+        fmt, mode, _ = self.read_header()
+        if fmt != "PNG" or mode not in passthrough_png_modes[layer_format]:
+            return None
+        return self.read()
+
+class Document:
+    """
+        the layer stack of an image.
+
+        Layers are held bottom to top in an insertion ordered dict, so they
+        are put on top of the stack and removed in constant time, and the
+        keys of the other layers stay the same meanwhile.
+
+        The layers that are selected by a layers filter are kept until the
+        stack is changed, see select.
+    """
+    __slots__ = ["layers", "next_key", "selections"]
+
+    def __init__(self, layers=[]):
+        """ layers are given from top to bottom """
+        self.layers = {}
+        self.next_key = 0
+        self.selections = {}
+        for layer in reversed(layers):
+            self.add(layer)
+
+    def add(self, layer):
+        """ puts the layer on top of the stack and returns its key """
+        key = self.next_key
+        self.next_key += 1
+        self.layers[key] = layer
+        self.selections.clear()
+        return key
+
+    def remove(self, key):
+        del self.layers[key]
+        self.selections.clear()
+
+    def select(self, layers):
+        """
+            returns (key, position counted from the bottom) of the layers
+            that match the layers filter from top to bottom
+        """
+        fkey, layer_filter = compiled_filter("layers", layers)
+        if fkey not in self.selections:
+            self.selections[fkey] = [(key, pos) for key,pos,layer in self.top_down()
+                                     if filter_matches(fkey, layer_filter, pos, layer.name)]
+        return self.selections[fkey]
+
+    def __getitem__(self, key):
+        return self.layers[key]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        """ iterates over the layers from top to bottom """
+        return reversed(self.layers.values())
+
+    def top_down(self):
+        """ returns (key, position counted from the bottom, layer) from top to bottom """
+        n = len(self.layers)
+        return [(key, n-nbr-1, layer) for nbr,(key,layer) in enumerate(reversed(self.layers.items()))]
+
+def crop_pixels(array, x=0, y=0, size=(0,0)):
+    """
+        returns (pixels, x, y, size) of the bounding box of the pixels of
+        array that are not transparent black, where array is placed at the
+        offset (x,y); parts left of or above the canvas are cut off.
+        size is enlarged such that it holds the whole array
+    """
+    if x < 0:
+        array = array[:,-x:]
+        x = 0
+    if y < 0:
+        array = array[-y:]
+        y = 0
+    size = (max(size[0], x + array.shape[1]), max(size[1], y + array.shape[0]))
+    mask = array.any(axis=-1) if len(array.shape) == 3 else array != 0
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return array[:0,:0], 0, 0, size
+    cropped = array[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+    if cropped.shape != array.shape:
+        # do not keep the whole array alive for a small view
+        cropped = cropped.copy()
+    return cropped, x + int(cols[0]), y + int(rows[0]), size
+
+def get_pixels(img):
+    """
+        returns the pixel array of a layer, which is decoded first for lazy layers
+    """
+    if isinstance(img, Layer):
+        return img.pixels()
+    return img
+
+def layer_attributes(img):
+    """
+        returns (x, y, opacity, visible) of a layer or pixel array
+    """
+    if isinstance(img, Layer):
+        if img.transform is not None:
+            # the offset is known after the transformation only
+            img.pixels()
+        return img.x, img.y, img.opacity, img.visible
+    return 0, 0, 1.0, True
+
+def placement(img):
+    """
+        returns (pixels, x, y, opacity, visible) of a layer or pixel array
+    """
+    return (get_pixels(img),) + layer_attributes(img)
+
+def is_empty(img):
+    """ whether the layer or pixel array has no pixels at all """
+    shape = img.shape
+    return shape[0] == 0 or shape[1] == 0
+
+def extent(img):
+    """
+        returns the size (w,h) of the area from the canvas origin that the
+        layer or pixel array spans
+    """
+    if isinstance(img, Layer) and img.transform is not None:
+        return img.transform[1]
+    shape = img.shape
+    if isinstance(img, Layer):
+        if is_empty(img):
+            return img.size
+        return max(img.size[0], img.x + shape[1]), max(img.size[1], img.y + shape[0])
+    return shape[1], shape[0]
+
+def canvas_size(imgs, size=None):
+    """
+        returns the size (w,h) of a canvas that is at least size and holds
+        all given layers
+    """
+    w, h = size if size is not None else (0, 0)
+    for img in imgs:
+        w0, h0 = extent(img)
+        w, h = max(w, w0), max(h, h0)
+    return w, h
+
+def canvas_pixels(img):
+    """
+        returns the uncropped pixels of a layer, i.e. the area from the canvas
+        origin that the layer spans
+    """
+    array, x, y, _, _ = placement(img)
+    w, h = extent(img)
+    if (x, y) == (0, 0) and array.shape[:2] == (h, w):
+        return array
+    output = np.zeros((h,w)+array.shape[2:],dtype=array.dtype)
+    output[y:y+array.shape[0], x:x+array.shape[1]] = array
+    return output
+
+def translation(x, y):
+    """ returns the affine map that moves the canvas by (x,y) pixels """
+    return np.array([[1,0,-x],[0,1,-y],[0,0,1]],dtype=np.float64)
+
+def flip_transform(axis, size):
+    """
+        returns the affine map that mirrors a canvas of size (w,h) at its
+        vertical (axis 1) or horizontal (axis 0) center line
+    """
+    w, h = size
+    if axis == 1:
+        return np.array([[-1,0,w-1],[0,1,0],[0,0,1]],dtype=np.float64)
+    return np.array([[1,0,0],[0,-1,h-1],[0,0,1]],dtype=np.float64)
+
+def rotation_transform(angle, size, center=None, resize=False):
+    """
+        returns (matrix, size) of the rotation of a canvas of size (w,h) by
+        angle degrees, which are the same as those of sit.rotate
+    """
+    cols, rows = size
+    if center is None:
+        center = np.array((cols, rows)) / 2. - 0.5
+    tform = (sit.SimilarityTransform(translation=-center) +
+             sit.SimilarityTransform(rotation=np.deg2rad(angle)) +
+             sit.SimilarityTransform(translation=center))
+    if resize:
+        corners = np.array([[0, 0], [0, rows - 1], [cols - 1, rows - 1], [cols - 1, 0]])
+        corners = tform.inverse(corners)
+        minc, minr = corners.min(axis=0)
+        maxc, maxr = corners.max(axis=0)
+        size = (int(np.around(maxc - minc + 1)), int(np.around(maxr - minr + 1)))
+        tform = sit.SimilarityTransform(translation=(minc, minr)) + tform
+    matrix = np.array(tform.params)
+    matrix[2] = (0, 0, 1)
+    return matrix, size
+
+def scale_transform(size, new_size):
+    """
+        returns the affine map that scales a canvas of size (w,h) to new_size
+        like sit.resize
+    """
+    sx = size[0] / max(new_size[0], 1)
+    sy = size[1] / max(new_size[1], 1)
+    return np.array([[sx,0,(sx-1)/2],[0,sy,(sy-1)/2],[0,0,1]],dtype=np.float64)
+
+def add_transform(layer, matrix, size, resample=None):
+    """
+        puts an affine transformation on the pending transform of the layer:
+        matrix maps the canvas of size (w,h) after the transformation to the
+        canvas before it, and resample is (order, mode, cval, clip) for
+        sit.warp, or None for flips and moves by whole pixels.
+
+        Flips and moves are composed with the pending transform, and the
+        parts of the layer that the pending transform has put beyond its
+        canvas stay cut off, see transform_window. Transformations with the
+        same resample parameters are composed if the pending transform
+        keeps all pixels on its canvas, so the layer is resampled only
+        once; otherwise the pending transform is applied first.
+    """
+    window = None
+    if layer.transform is not None:
+        pending, pending_size, pending_resample, pending_window = layer.transform
+        if resample is None:
+            window = transform_window(matrix, size, pending_size, pending_window)
+            matrix = pending @ matrix
+            resample = pending_resample
+        elif (pending_resample is None or resample == pending_resample) and keeps_pixels(layer):
+            matrix = pending @ matrix
+        else:
+            apply_transform(layer)
+    layer.transform = (matrix, size, resample, window)
+    layer.dirty = True
+    layer.header = None
+
+def transform_window(matrix, size, old_size, window=None):
+    """
+        returns the area (x0,y0,x1,y1) of the canvas of size (w,h) after a
+        flip or move by matrix that shows the area window of the canvas of
+        size old_size before it, or None if it is the whole canvas
+    """
+    x0, y0, x1, y1 = (0, 0) + tuple(old_size) if window is None else window
+    x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, old_size[0]), min(y1, old_size[1])
+    if x0 >= x1 or y0 >= y1:
+        return (0, 0, 0, 0)
+    corners = np.rint(np.linalg.inv(matrix) @ [[x0, x1-1], [y0, y1-1], [1, 1]])
+    x0, x1 = int(corners[0].min()), int(corners[0].max()) + 1
+    y0, y1 = int(corners[1].min()), int(corners[1].max()) + 1
+    if x0 <= 0 and y0 <= 0 and x1 >= size[0] and y1 >= size[1]:
+        return None
+    return x0, y0, x1, y1
+
+def keeps_pixels(layer):
+    """
+        whether the pending transform of the layer maps all its pixels
+        that are not transparent black onto its canvas, i.e. whether the
+        transform cuts nothing off
+    """
+    matrix, (w, h), resample, window = layer.transform
+    reach = 0
+    if resample is not None:
+        order, mode, cval, _ = resample
+        if mode != "constant" or cval != 0:
+            # the pixels outside the layer are not transparent black
+            return False
+        # output pixels are interpolated from the source pixels this close
+        reach = order + 1
+    if layer.array is not None:
+        h0, w0 = layer.array.shape[:2]
+    else:
+        w0, h0 = layer.read_header()[2]
+    if w0 == 0 or h0 == 0:
+        return True
+    x0, y0, x1, y1 = (0, 0, w, h) if window is None else window
+    left, right = layer.x - reach, layer.x + w0 - 1 + reach
+    top, bottom = layer.y - reach, layer.y + h0 - 1 + reach
+    corners = np.linalg.inv(matrix) @ [[left, right, left, right], [top, top, bottom, bottom], [1, 1, 1, 1]]
+    eps = 1e-9
+    return (corners[0].min() >= max(x0, 0) - eps and corners[0].max() <= min(x1, w) - 1 + eps and
+            corners[1].min() >= max(y0, 0) - eps and corners[1].max() <= min(y1, h) - 1 + eps)
+
+def clip_layer(layer, window):
+    """ cuts off the pixels of the layer outside the area (x0,y0,x1,y1) of the canvas """
+    x0, y0, x1, y1 = window
+    array = layer.array
+    top, left = max(y0 - layer.y, 0), max(x0 - layer.x, 0)
+    bottom = max(min(y1 - layer.y, array.shape[0]), top)
+    right = max(min(x1 - layer.x, array.shape[1]), left)
+    if (top, left, bottom, right) != (0, 0) + array.shape[:2]:
+        layer.set_pixels(array[top:bottom, left:right], layer.x + left, layer.y + top, layer.size)
+
+def exact_samples(scale, offset, n, order):
+    """
+        returns (indices, half) of the source pixels that n output pixels
+        along an axis sample at scale * output index + offset: either each
+        output pixel takes a source pixel (half is False), or, for linear
+        interpolation, the mean of a source pixel and the next one (half is
+        True). Returns None, if the samples are not taken exactly this way.
+    """
+    positions = scale * np.arange(n) + offset
+    nearest = np.rint(positions)
+    if n == 0 or np.abs(positions - nearest).max() < 1e-9:
+        return nearest.astype(np.int64), False
+    if order == 0:
+        # ties might be rounded either way
+        if np.abs(positions - np.floor(positions) - 0.5).min() < 1e-9:
+            return None
+        return nearest.astype(np.int64), False
+    if order == 1:
+        lower = np.floor(positions)
+        if np.abs(positions - lower - 0.5).max() < 1e-9:
+            return lower.astype(np.int64), True
+    return None
+
+def take_samples(array, axis, indices, half):
+    """
+        returns the samples of exact_samples along the axis of array, where
+        indices are relative to the array and indices beyond the array are
+        transparent black
+    """
+    if not half:
+        steps = np.unique(np.diff(indices))
+        if len(steps) == 1 and abs(steps[0]) == 1:
+            # moves and flips only take a view
+            lo = min(indices[0], indices[-1])
+            view = array[lo:lo+len(indices)] if axis == 0 else array[:,lo:lo+len(indices)]
+            return view if indices[0] == lo else np.flip(view, axis=axis)
+        return array.take(indices, axis=axis)
+    lower = np.clip(indices, -1, array.shape[axis])
+    upper = np.clip(indices + 1, -1, array.shape[axis])
+    pad = [(0,0)] * len(array.shape)
+    pad[axis] = (1,1)
+    array = np.pad(array.astype(np.uint16), pad)
+    return array.take(lower + 1, axis=axis) + array.take(upper + 1, axis=axis)
+
+def exact_transform(layer, matrix, size, resample):
+    """
+        applies a transform that moves, flips, rotates by multiples of 90
+        degrees or scales by integer factors without resampling, if sit.warp
+        would sample whole pixels or the means of two neighboring pixels;
+        returns whether it did so. The pixels are taken as they are, and
+        means are rounded down, whereas sit.warp may round a channel value
+        down by one due to floating point errors.
+    """
+    m = np.where(np.abs(matrix) < 1e-12, 0, matrix)
+    if m[0,1] == 0 and m[1,0] == 0 and m[0,0] != 0 and m[1,1] != 0:
+        swapped = False
+    elif m[0,0] == 0 and m[1,1] == 0 and m[0,1] != 0 and m[1,0] != 0:
+        swapped = True
+    else:
+        return False
+    order = 0 if resample is None else resample[0]
+    if not order in [0, 1] and resample is not None:
+        # higher order splines reproduce pixels only up to rounding errors,
+        # but they may still be taken exactly
+        order = -1
+    src_w, src_h = extent(layer)
+    pixels, x, y, _, _ = placement(layer)
+    w, h = size
+    # output rows and columns sample (scale, offset, start, canvas length)
+    # of the source columns or rows
+    cols = (m[0,0], m[0,2], x, src_w)
+    rows = (m[1,1], m[1,2], y, src_h)
+    if swapped:
+        pixels = pixels.swapaxes(0,1)
+        rows = (m[0,1], m[0,2], x, src_w)
+        cols = (m[1,0], m[1,2], y, src_h)
+    samples = []
+    for scale, offset, start, length in [rows, cols]:
+        s = exact_samples(scale, offset, h if len(samples) == 0 else w, order)
+        if s is None:
+            return False
+        indices, half = s
+        inside = len(indices) == 0 or (indices.min() >= 0 and indices.max() + half < length)
+        if not inside and resample is not None and (resample[1] != "constant" or resample[2] != 0):
+            # the border mode decides about the pixels outside the canvas
+            return False
+        samples.append((indices - start, half))
+    # only output pixels that sample the pixel array are computed
+    area = []
+    for axis, (indices, half) in enumerate(samples):
+        valid = np.flatnonzero((indices + half >= 0) & (indices < pixels.shape[axis]))
+        area.append((valid[0], valid[-1] + 1) if len(valid) else (0, 0))
+    (r0, r1), (c0, c1) = area
+    if r0 == r1 or c0 == c1:
+        layer.set_pixels(np.zeros((0,0)+pixels.shape[2:],dtype=np.uint8), size=size)
+        return True
+    result = take_samples(pixels, 0, samples[0][0][r0:r1], samples[0][1])
+    result = take_samples(result, 1, samples[1][0][c0:c1], samples[1][1])
+    if result.dtype != np.uint8:
+        # the mean of 2 or 4 pixels is truncated like the result of sit.warp
+        result = (result // ((1 + samples[0][1]) * (1 + samples[1][1]))).astype(np.uint8)
+    layer.set_pixels(result, c0, r0, size)
+    return True
+
+def apply_transform(layer):
+    """
+        applies the pending transform of a layer to its pixels; flips and
+        moves by whole pixels only take views of the pixels
+    """
+    matrix, size, resample, window = layer.transform
+    layer.transform = None
+    w, h = size
+    if not exact_transform(layer, matrix, size, resample):
+        canvas = canvas_pixels(layer)
+        if canvas.size == 0 or w == 0 or h == 0:
+            layer.set_pixels(np.zeros((0,0)+canvas.shape[2:],dtype=np.uint8), size=size)
+            return
+        order, mode, cval, clip = resample
+        pixels = sit.warp(canvas, matrix, output_shape=(h,w), order=order, mode=mode,
+                          cval=cval, clip=clip, preserve_range=True)
+        layer.set_pixels(pixels.astype(np.uint8), size=size)
+    if window is not None:
+        clip_layer(layer, window)
+
+def map_layer_pixels(layer, fn):
+    """
+        applies the per pixel function fn to the pixels of a layer; fn is
+        applied to the cropped pixels only, unless it changes transparent
+        black
+    """
+    array, x, y, _, _ = placement(layer)
+    w, h = extent(layer)
+    result = fn(array) if not is_empty(layer) else array
+    background = fn(np.zeros((1,1)+array.shape[2:],dtype=array.dtype))
+    if background.any():
+        output = np.empty((h,w)+result.shape[2:],dtype=result.dtype)
+        output[...] = background[0,0]
+        output[y:y+result.shape[0], x:x+result.shape[1]] = result
+        result, x, y = output, 0, 0
+    layer.set_pixels(result, x, y, (w,h))
+
+# per pixel ops are applied to horizontal strips of about this many pixels
+# at a time, so all fused ops work on a strip while it is in the cache
+pixel_op_strip_pixels = 1 << 16
+
+def run_pixel_ops(img, fns):
+    """
+        applies the per pixel functions fns one after another to the pixel
+        array img strip by strip, which is changed in place and returned;
+        each function may change its argument in place or return a new
+        array of the same shape
+    """
+    rows = max(1, pixel_op_strip_pixels // max(img.shape[1], 1))
+    for y in range(0, img.shape[0], rows):
+        strip = img[y:y+rows]
+        for fn in fns:
+            result = fn(strip)
+            if result is not strip:
+                strip[...] = result
+    return img
+
+def map_layer_pixel_ops(layer, fns):
+    """
+        applies the per pixel functions fns to the pixels of a layer, see
+        run_pixel_ops; they work in place on the cropped pixels unless they
+        change transparent black
+    """
+    background = run_pixel_ops(np.zeros((1,1)+layer.shape[2:],dtype=np.uint8), fns)
+    if background.any():
+        map_layer_pixels(layer, lambda x: run_pixel_ops(np.copy(x), fns))
+        return
+    pixels = run_pixel_ops(layer.writable_pixels(), fns)
+    # pixels might have become transparent black
+    layer.set_pixels(pixels, layer.x, layer.y, layer.size, owned=True)
+
+def padded_pixels(img, pad):
+    """
+        returns (pixels, x, y) of the area of a layer that is enlarged by pad
+        pixels on each side, but not beyond the area that the layer spans
+    """
+    array, x, y, _, _ = placement(img)
+    w, h = extent(img)
+    x0, y0 = max(x-pad, 0), max(y-pad, 0)
+    x1, y1 = min(x+array.shape[1]+pad, w), min(y+array.shape[0]+pad, h)
+    output = np.zeros((y1-y0, x1-x0)+array.shape[2:],dtype=array.dtype)
+    output[y-y0:y-y0+array.shape[0], x-x0:x-x0+array.shape[1]] = array
+    return output, x0, y0
+
+def merge_layer_area(name, imgs):
+    """
+        merges a list of layers into a single new layer, where only the area
+        of the visible layers is blended
+    """
+    size = canvas_size(imgs)
+    layer = Layer(name)
+    visible = [img for img in imgs if layer_attributes(img)[3] and not is_empty(img)]
+    if len(visible) == 0:
+        layer.set_pixels(np.zeros((0,0,4),dtype=np.uint8), size=size)
+        return layer
+    x0 = min([layer_attributes(img)[0] for img in visible])
+    y0 = min([layer_attributes(img)[1] for img in visible])
+    x1 = max([layer_attributes(img)[0] + img.shape[1] for img in visible])
+    y1 = max([layer_attributes(img)[1] + img.shape[0] for img in visible])
+    layer.set_pixels(merge_layers(visible, (x0, y0, x1-x0, y1-y0)), x0, y0, size)
+    return layer
+
+def worker_count(workers):
+    """
+        returns the number of threads for the workers option value
+    """
+    workers = int(workers)
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+def parallel_map(fn, items, workers=1):
+    """
+        returns [fn(x) for x in items], computed by up to workers threads
+    """
+    items = list(items)
+    workers = min(worker_count(workers), len(items))
+    if workers <= 1:
+        return [fn(x) for x in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(fn, items))
+
+def decode_layers(imgs, workers=1):
+    """
+        decodes the given lazy layers and applies their pending transforms in
+        parallel
+    """
+    lazy = {}
+    for img in imgs:
+        if isinstance(img, Layer) and (img.array is None or img.transform is not None):
+            lazy[id(img)] = img
+    parallel_map(Layer.pixels, lazy.values(), workers)
+
+# OpenRaster files that are kept open for their lazy layers, the layer
+# stacks as they were loaded from them, and the layer caches they use
+open_ora_files = []
+ora_file_stacks = {}
+ora_file_caches = {}
+
+def close_ora_files():
+    for f in open_ora_files:
+        f.close()
+    open_ora_files.clear()
+    ora_file_stacks.clear()
+    ora_file_caches.clear()
+    filter_results.clear()
+
+# OpenRaster files that have been stored by earlier tasks of this process for
+# later tasks, which load them from memory: path -> [loads left, future of the
+# file bytes, layers from top to bottom, canvas size]
+handed_images = {}
+
+# files that are written in the background: path -> thread, and the
+# (path, exception) of the writes that have failed
+pending_writes = {}
+write_errors = []
+
+def normal_path(path):
+    """ returns the absolute path that identifies a file across tasks """
+    return os.path.abspath(os.path.expanduser(str(path)))
+
+class HandedFile:
+    """
+        stands in for the zip file of the layers that are loaded from a
+        handed over image, whose OpenRaster file is encoded in the
+        background; it waits for the file bytes when it is used for the
+        first time
+    """
+    def __init__(self, future):
+        self.future = future
+        self.zf = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        with self.lock:
+            if self.zf is None:
+                self.zf = zipfile.ZipFile(io.BytesIO(self.future.result()))
+        return getattr(self.zf, name)
+
+    def close(self):
+        if self.zf is not None:
+            self.zf.close()
+
+def hand_over(path, doc, layer_format="rgba", workers=1, loads=1):
+    """
+        stores the document for the next loads of path by later tasks, and
+        encodes and writes the OpenRaster file in the background.
+
+        The later tasks share the pixels of the layers right away. They wait
+        for the file bytes only when they use them, i.e. when they copy the
+        png files of unchanged layers or the merged image to their outputs.
+    """
+    path = normal_path(path)
+    layers = [layer.copy() for layer in doc]
+    # the offsets and the canvas are known once the pending transforms are
+    # applied
+    decode_layers([layer for layer in layers if layer.transform is not None], workers)
+    w, h = canvas_size(layers)
+    w, h = max(w,1), max(h,1)
+    # the files of lazy layers are closed at the end of the task, so what
+    # is copied from them is read right away, and the other layers are
+    # decoded for the encoding
+    composite = loaded_composite(layers, w, h)
+    merged = updated_composite(layers, w, h) if composite[0] is None else None
+    copied = [layer.png_bytes(layer_format) for layer in layers]
+    decode_layers([layer for layer, data in zip(layers, copied)
+                   if data is None or (composite[0] is None and merged is None)], workers)
+    future = Future()
+    handed_images[path] = [loads, future, layers, (w,h)]
+    wait_for_writes([path])
+    def write():
+        try:
+            data = ora_bytes(layers, layer_format, workers, copied, composite, merged)
+            future.set_result(data)
+            write_file(path, lambda f: f.write(data))
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            write_errors.append((path, e))
+    pending_writes[path] = threading.Thread(target=write)
+    pending_writes[path].start()
+
+def handed_document(handed):
+    """
+        returns the document of a handed over image, whose layers share the
+        pixels of the stored layers
+    """
+    _, future, stored, size = handed
+    f = HandedFile(future)
+    layers = []
+    for nbr, layer in enumerate(stored):
+        array = layer.array
+        if array is not None and (array.dtype != np.uint8 or array.ndim != 3 or array.shape[-1] != 4 or array.size == 0):
+            # such layers are decoded from the file like write_ora stored them
+            array = None
+        # the layers are stored from data/layer0.png at the bottom upwards
+        layers.append(Layer(layer.name, array, layer.x, layer.y, layer.opacity, layer.visible,
+                            size, (f, f"data/layer{len(stored)-nbr-1}.png")))
+    open_ora_files.append(f)
+    ora_file_stacks[f] = [stack_entry(layer) for layer in layers]
+    return Document(layers)
+
+def release_handed(path):
+    """ counts a load of a handed over path; returns its entry or None """
+    handed = handed_images.get(path)
+    if handed is not None:
+        handed[0] -= 1
+        if handed[0] <= 0:
+            del handed_images[path]
+    return handed
+
+def wait_for_writes(paths=None):
+    """
+        waits until the background writes of the given paths, or of all
+        files, are done
+    """
+    for path in list(pending_writes) if paths is None else paths:
+        thread = pending_writes.pop(path, None)
+        if thread is not None:
+            thread.join()
+
+def load_ora(path, cache_dir=None, cache_size=0):
     """
         Loads an Open Raster image; as it might have been saved by krita or pinta...
+
+        The layer pixels are decoded when they are needed, so the file stays
+        open until close_ora_files is called. Decoded layers are kept in the
+        layer cache below cache_dir, which may grow up to cache_size megabytes.
+        Images that have been handed over by an earlier task are taken from
+        memory.
     """
+    handed = release_handed(normal_path(path))
+    if handed is not None:
+        return handed_document(handed)
+    wait_for_writes([normal_path(path)])
+    f = zipfile.ZipFile(path)
+    files = list(f.namelist())
+    if 'stack.xml' not in files:
+        f.close()
+        return None
+    info = xmltodict.parse(f.read('stack.xml'))
+    # each layer spans the whole canvas, but may be stored cropped
+    size = (int(info['image'].get('@w',0)), int(info['image'].get('@h',0)))
     layers = []
-    with zipfile.ZipFile(path) as f:
-        files = list(f.namelist())
-        if 'stack.xml' not in files:
-            return None
-        info = xmltodict.parse(f.read('stack.xml'))
-        layer_names_srcs = list(map(lambda x: (x['@name'],x['@src']), coerce_to_list(info['image']['stack']['layer'])))
-        layers = [ (lbl, img_to_np(f.open(src))) for lbl,src in layer_names_srcs]
-    return layers
+    for x in coerce_to_list(info['image']['stack']['layer']):
+        layers.append(Layer(x['@name'], None, int(x.get('@x',0)), int(x.get('@y',0)),
+                            float(x.get('@opacity',1)), x.get('@visibility','visible') != 'hidden',
+                            size, (f, x['@src'])))
+    open_ora_files.append(f)
+    ora_file_stacks[f] = [stack_entry(layer) for layer in layers]
+    if cache_dir and float(cache_size) > 0:
+        ora_file_caches[f] = (os.path.join(os.path.expanduser(cache_dir), "layers"), int(float(cache_size) * (1 << 20)))
+    for layer in layers:
+        if layer.x < 0 or layer.y < 0:
+            # parts left of or above the canvas are cut off, so all layers
+            # have non-negative offsets
+            layer.set_pixels(layer.pixels(), layer.x, layer.y, size)
+    return Document(layers)
+
+# bump this whenever the way layers are decoded changes, so that cached layers
+# are no longer valid
+layer_cache_version = 1
+
+# guards the eviction from the layer caches, and the bytes that are stored in
+# each layer cache directory as far as this process knows
+layer_cache_lock = threading.Lock()
+layer_cache_usage = {}
+
+def layer_cache_path(cache, source):
+    """
+        returns the path of the cached decoded layer of the source zip entry,
+        named after a hash of the zip file path and the CRC32 and size of
+        the entry, which are known without decompressing it
+    """
+    zf, entry = source
+    info = zf.getinfo(entry)
+    key = hashlib.sha1(repr((layer_cache_version, os.path.abspath(zf.filename), entry,
+                             info.CRC, info.file_size)).encode("utf-8")).hexdigest()
+    return os.path.join(cache[0], key + ".npy")
+
+def evict_layer_cache(cache, added):
+    """
+        accounts for added bytes in the layer cache, and removes the least
+        recently used layers once it exceeds its size limit
+    """
+    cache_dir, limit = cache
+    with layer_cache_lock:
+        if cache_dir in layer_cache_usage:
+            layer_cache_usage[cache_dir] += added
+            if layer_cache_usage[cache_dir] <= limit:
+                return
+        files = []
+        with os.scandir(cache_dir) as it:
+            for e in it:
+                if e.name.endswith(".npy"):
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, e.path))
+        usage = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if usage <= limit:
+                break
+            try:
+                os.remove(path)
+                usage -= size
+            except OSError:
+                pass
+        layer_cache_usage[cache_dir] = usage
+
+def decode_source(source):
+    """
+        returns the pixels of the png image in the source zip entry; layers of
+        files with a layer cache are memory-mapped read-only from it, or
+        stored there once they have been decoded
+    """
+    cache = ora_file_caches.get(source[0])
+    path = None
+    if cache is not None:
+        with zip_lock:
+            path = layer_cache_path(cache, source)
+        if os.path.exists(path):
+            try:
+                array = np.load(path, mmap_mode="r")
+                # the modification time orders the layers for the eviction
+                os.utime(path)
+                return array
+            except (OSError, ValueError):
+                print(f"WARNING: ignoring broken cached layer '{path}'.")
+    zf, entry = source
+    with zip_lock:
+        data = zf.read(entry)
+    array = img_to_np(io.BytesIO(data))
+    if path is not None:
+        tmp = None
+        try:
+            os.makedirs(cache[0], exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".npy.tmp", dir=cache[0])
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp, path)
+            evict_layer_cache(cache, os.path.getsize(path))
+        except OSError as e:
+            print(f"WARNING: could not store cached layer '{path}': {e}")
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+    return array
+
+def stack_entry(layer):
+    """
+        returns what determines the contribution of an unchanged layer to the
+        merged image
+    """
+    return (layer.source, layer.x, layer.y, layer.opacity, layer.visible)
     
 def load_single_layer(path,name="default"):
     """
         Loads a single layer png :)
     """
-    return [(name,img_to_np(path))]
+    return Document([Layer(name, img_to_np(path))])
     
-def write_ora(path,layers):
-    w = max([x[1].shape[1] for x in layers] )
-    h = max([x[1].shape[0] for x in layers] )
+def to_indexed_image(img):
+    """
+        returns the RGBA pixel array as paletted image with transparency, if
+        it has at most 256 distinct colors, otherwise None
+    """
+    if len(img.shape) != 3 or img.shape[-1] != 4 or img.dtype != np.uint8:
+        return None
+    colors, indices = np.unique(pack_colors(img.reshape((-1,4))), return_inverse=True)
+    if len(colors) > 256:
+        return None
+    palette = unpack_colors(colors, 4)
+    pimg = Image.frombytes("P", (img.shape[1], img.shape[0]), indices.astype(np.uint8).tobytes())
+    # Pillow picks a bit depth of 1, 2, 4 or 8 from the palette size
+    pimg.putpalette(palette[:,:3].tobytes())
+    if (palette[:,3] != 255).any():
+        pimg.info["transparency"] = palette[:,3].tobytes()
+    return pimg
+
+def layer_to_image(img, layer_format="rgba"):
+    """
+        returns the PIL image that stores the pixel array of a layer in the
+        given layer format, see option layer-format
+    """
+    if layer_format == "indexed":
+        pimg = to_indexed_image(img)
+        if pimg is not None:
+            return pimg
+    return Image.fromarray(img)
+
+def png_bytes(pimg):
+    """
+        returns the PIL image encoded as png file
+    """
+    buf = io.BytesIO()
+    pimg.save(buf,"PNG")
+    return buf.getvalue()
+
+def layer_png_bytes(img, layer_format="rgba"):
+    """
+        returns the png file of a layer in the given layer format
+    """
+    # unmodified layers are copied over without re-encoding
+    data = img.png_bytes(layer_format)
+    if data is None:
+        pixels = get_pixels(img)
+        if pixels.size == 0:
+            # empty layers are stored as a single transparent pixel
+            pixels = np.zeros((1,1,4),dtype=np.uint8)
+        data = png_bytes(layer_to_image(pixels, layer_format))
+    return data
+
+def format_opacity(opacity):
+    """ formats the opacity of a layer for stack.xml """
+    if round(opacity, 2) == opacity:
+        return f"{opacity:.2f}"
+    return f"{opacity:.6f}"
+
+def loaded_composite(imgs, w, h):
+    """
+        returns the png files of the merged image and the thumbnail of the
+        OpenRaster file that the layer stack imgs has been loaded from, if
+        no layer has been changed, added, removed or reordered since;
+        otherwise returns None, None
+    """
+    if len(imgs) == 0 or any(img.dirty for img in imgs):
+        return None, None
+    f = imgs[0].source[0]
+    if ora_file_stacks.get(f) != [stack_entry(img) for img in imgs]:
+        return None, None
+    files = f.namelist()
+    if "mergedimage.png" not in files:
+        return None, None
+    with zip_lock:
+        merged_data = f.read("mergedimage.png")
+        thumb_data = None
+        if "Thumbnails/thumbnail.png" in files:
+            thumb_data = f.read("Thumbnails/thumbnail.png")
+    merged = Image.open(io.BytesIO(merged_data))
+    if merged.format != "PNG" or merged.size != (w,h):
+        return None, None
+    return merged_data, thumb_data
+
+def updated_composite(imgs, w, h):
+    """
+        returns the merged image of the layer stack imgs as RGBA array, that
+        is updated from the merged image of the OpenRaster file the stack has
+        been loaded from, if only some of its layers have been changed or
+        removed since; otherwise returns None.
+
+        Transparent pixels do not change a composite, so the merged image of
+        the file stays the composite of the untouched layers outside the
+        areas of the changed and removed layers, and only these areas are
+        blended again.
+    """
+    if len(imgs) == 0 or any(img.source is None for img in imgs):
+        return None
+    f = imgs[0].source[0]
+    loaded = ora_file_stacks.get(f)
+    if loaded is None:
+        return None
+    sources = [entry[0] for entry in loaded]
+    positions = [sources.index(img.source) if img.source in sources else -1 for img in imgs]
+    if -1 in positions or positions != sorted(set(positions)):
+        # layers have been added or reordered
+        return None
+    changed = [entry for n, entry in enumerate(loaded) if n not in positions]
+    changed += [loaded[n] for n, img in zip(positions, imgs) if img.dirty or stack_entry(img) != loaded[n]]
+    if len(changed) == 0 or "mergedimage.png" not in f.namelist():
+        return None
+    areas = []
+    for (zf, entry), x, y, _, _ in changed:
+        with zip_lock:
+            with zf.open(entry) as fp:
+                size = Image.open(fp).size
+        area = [x, y, x + size[0], y + size[1]]
+        for img in imgs:
+            if img.source == (zf, entry) and not is_empty(img):
+                # the layer spans its area before and after the changes
+                x, y = layer_attributes(img)[:2]
+                area = [min(area[0], x), min(area[1], y),
+                        max(area[2], x + img.shape[1]), max(area[3], y + img.shape[0])]
+        area = [max(area[0], 0), max(area[1], 0), min(area[2], w), min(area[3], h)]
+        if area[0] < area[2] and area[1] < area[3]:
+            areas.append(area)
+    if sum([(x1-x0)*(y1-y0) for x0, y0, x1, y1 in areas]) >= w*h:
+        return None
+    with zip_lock:
+        merged = img_to_np(io.BytesIO(f.read("mergedimage.png")))
+    if merged.shape[0] > h or merged.shape[1] > w or merged.dtype != np.uint8:
+        return None
+    # only the changed layers may span a larger canvas than before
+    merged = np.pad(merged, ((0,h-merged.shape[0]), (0,w-merged.shape[1]), (0,0)))
+    for x0, y0, x1, y1 in areas:
+        # only the layers that overlap the area are decoded
+        overlapping = []
+        for img in imgs:
+            x, y = layer_attributes(img)[:2]
+            if not is_empty(img) and x < x1 and y < y1 and x + img.shape[1] > x0 and y + img.shape[0] > y0:
+                overlapping.append(img)
+        merged[y0:y1, x0:x1] = merge_layers(overlapping, (x0, y0, x1-x0, y1-y0))
+    return merged
+
+def write_ora(path,doc,layer_format="rgba",workers=1):
+    """
+        writes the layers of the document to an OpenRaster file, whose canvas
+        holds the areas spanned by all layers
+    """
+    # an earlier write of the same file in the background must not replace
+    # this one
+    wait_for_writes([normal_path(path)])
+    write_file(path, lambda f: write_ora_file(f, list(doc), layer_format, workers))
+
+# permissions of written files, as open would create them
+file_mode = os.umask(0)
+os.umask(file_mode)
+file_mode = 0o666 & ~file_mode
+
+def write_file(path, write):
+    """ writes the file at path by calling write with the binary file object """
+    # the file is written under a temporary name first, so lazy layers can
+    # still be read if the output replaces one of the input files
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.chmod(tmp_path, file_mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def ora_bytes(layers,layer_format="rgba",workers=1,copied=None,composite=None,merged=None):
+    """
+        returns the OpenRaster file of the layers from top to bottom as bytes,
+        see write_ora_file
+    """
+    buf = io.BytesIO()
+    write_ora_file(buf, layers, layer_format, workers, copied, composite, merged)
+    return buf.getvalue()
+
+def write_ora_file(fp,layers,layer_format="rgba",workers=1,copied=None,composite=None,merged=None):
+    """
+        writes the OpenRaster file of the layers from top to bottom to the
+        binary file object fp; copied are the png files of the layers that
+        have been read already, or None for those that are encoded, and
+        composite are the png files of the merged image and the thumbnail
+        that loaded_composite returns, which it is called for if None, and
+        merged is the merged image as RGBA array, if it is known already
+    """
+    if copied is None:
+        copied = [None] * len(layers)
+    # layers are encoded in parallel, but written in order; this applies
+    # the pending transforms, which determine the offsets of the layers
+    layer_data = parallel_map(lambda x: x[1] if x[1] is not None else layer_png_bytes(x[0], layer_format),
+                              zip(layers, copied), workers)
+    w, h = canvas_size(layers)
+    w, h = max(w,1), max(h,1)
     L0 = len(layers) - 1
     stackxml = f'<image w="{w}" h="{h}">' + "\n"
     stackxml += '  <stack opacity="1" name="root">\n'
     l0 = L0
-    for name, _ in layers:
-        stackxml += f'    <layer opacity="1.00" name="{name}" composite-op="svg:src-over" src="data/layer{l0}.png" />' + "\n"
+    for layer in layers:
+        visibility = "visible" if layer.visible else "hidden"
+        stackxml += f'    <layer opacity="{format_opacity(layer.opacity)}" name="{layer.name}" visibility="{visibility}" x="{layer.x}" y="{layer.y}" composite-op="svg:src-over" src="data/layer{l0}.png" />' + "\n"
         l0 -= 1
     stackxml += '  </stack>\n'
     stackxml += "</image>"
-    with zipfile.ZipFile(path,"w",compression=zipfile.ZIP_DEFLATED) as f:
+    with zipfile.ZipFile(fp,"w",compression=zipfile.ZIP_DEFLATED) as f:
         f.writestr("mimetype","image/openraster")
         f.writestr("stack.xml",stackxml)
         l0 = L0
-        for _, img in layers:
+        for data in layer_data:
             lpath = f"data/layer{l0}.png"
-            pimg = Image.fromarray(img)
-            with f.open(lpath,"w") as pf:
-                pimg.save(pf,"PNG")
-                pf.close()
+            # png data is already deflated, so it is stored as it is
+            f.writestr(lpath, data, compress_type=zipfile.ZIP_STORED)
             l0 -= 1
-        # add a merged image
-        merged_img = merge_layers([img for lbl,img in layers])
+        # add a merged image, which is taken over from the loaded file if
+        # the layer stack is unchanged
+        merged_data, thumb_data = loaded_composite(layers, w, h) if composite is None else composite
+        merged_img = None
+        if merged_data is None:
+            merged_img = merged if composite is not None else updated_composite(layers, w, h)
+            if merged_img is None:
+                decode_layers(layers, workers)
+                merged_img = merge_layers_cached(layers, w, h)
+            merged_data = png_bytes(Image.fromarray(merged_img))
         lpath = f"mergedimage.png"
-        pimg = Image.fromarray(merged_img)
-        with f.open(lpath,"w") as pf:
-            pimg.save(pf,"PNG")
-            pf.close()
-        if w > h:
-            tw = 32
-            th = int(h*tw/w+.5)
-        else:
-            th = 32
-            tw = int(w*th/h+.5)
-        # and even a real thumbnail so Pinta's file open menu works now
-        thumb_img = (sit.resize(merged_img/255.,(th,tw,4),mode='reflect',order=1,anti_aliasing=True)*255).astype(np.uint8)
-        with f.open("Thumbnails/thumbnail.png","w") as pf:
+        f.writestr(lpath, merged_data, compress_type=zipfile.ZIP_STORED)
+        if thumb_data is None:
+            if merged_img is None:
+                merged_img = img_to_np(io.BytesIO(merged_data))
+            if w > h:
+                tw = 32
+                th = int(h*tw/w+.5)
+            else:
+                th = 32
+                tw = int(w*th/h+.5)
+            # and even a real thumbnail so Pinta's file open menu works now
+            thumb_img = (sit.resize(merged_img/255.,(th,tw,4),mode='reflect',order=1,anti_aliasing=True)*255).astype(np.uint8)
             thimg = Image.fromarray(thumb_img)
-            thimg.save(pf,"PNG")
-            pf.close()
-        f.close()
+            thumb_data = png_bytes(thimg)
+        f.writestr("Thumbnails/thumbnail.png", thumb_data, compress_type=zipfile.ZIP_STORED)
 
     
-def to_nearest_palette(img, palette = ega_palette, divisor=255,colorspace="rgb"):
-    shape = img.shape
-    channels = shape[-1]
-    dims = shape[:-1]
-    if channels == ega_palette.shape[-1] + 1:
-        has_alpha = True
-    else:
-        has_alpha = False
-    if colorspace in ["hls","hsv","yiq"]:
-        color_fn0 = {'hls':colorsys.rgb_to_hls,'hsv':colorsys.rgb_to_hsv,'yiq':colorsys.rgb_to_yiq}[colorspace]
-        color_fn = lambda r,g,b: np.array(color_fn0(r/divisor,g/divisor,b/divisor))*divisor
-        new_values = [color_fn(r,g,b) for r,g,b in palette[:,:3]]
-        dist_palette = np.copy(palette).astype(np.float)
-        for idx,x in enumerate(new_values):
-            dist_palette[idx,:3] = x
+
+# upper bound for the number of floats that are held in a single temporary
+# array while computing the distances between pixels and palette colors
+nearest_palette_chunk_elements = 1 << 20
+
+# palettes with at least this many colors are searched using a k-d tree,
+# see: ./ora-tool.py benchmark palette-index
+kdtree_palette_size = 64
+
+# k-d trees of the most recently used palettes
+palette_trees = OrderedDict()
+palette_trees_size = 16
+
+def get_palette_tree(dist_palette):
+    """
+        returns a (cached) k-d tree of the given palette colors
+    """
+    key = (dist_palette.shape, dist_palette.tobytes())
+    if key in palette_trees:
+        palette_trees.move_to_end(key)
     else:
-        color_fn = lambda r,g,b:(r,g,b)
-        dist_palette = palette
-    linear = 1
-    for x in dims:
-        linear *= x
-    img0 = np.copy(img.reshape((linear, channels)))
-    if img0.shape[1] >= 3:
-        rgb0 = img0[:,:3]
-        for l in range(rgb0.shape[0]):
-                img0[l,:3] = color_fn(rgb0[l,0],rgb0[l,1],rgb0[l,2])
-                
-    for i in range(linear):
-        if has_alpha:
-            x = img0[i][:-1]
+        palette_trees[key] = spatial.cKDTree(dist_palette)
+        while len(palette_trees) > palette_trees_size:
+            palette_trees.popitem(last=False)
+    return palette_trees[key]
+
+def palette_distances(x, dist_palette, divisor, candidates=None):
+    """
+        returns the distances between the float rows x and all palette
+        colors, or between each row x[i] and the palette colors with the
+        indices candidates[i]
+    """
+    distances = None
+    for c in range(dist_palette.shape[1]):
+        # sum up the squared channel differences one channel at a time, which
+        # keeps the temporaries small and adds in the same order as np.sum
+        if candidates is None:
+            d = (x[:,c,None] - dist_palette[None,:,c])/divisor
         else:
-            x = img0[i]
-        distances = [np.sqrt(np.sum(((x - p)/divisor)**2)) for p in dist_palette]
-        d0 = min(distances)
-        x = palette[distances.index(d0)]
-        if has_alpha:
-            img0[i][:-1] = x
+            d = (x[:,c,None] - dist_palette[candidates,c])/divisor
+        d *= d
+        if distances is None:
+            distances = d
         else:
-            img0[i] = x
-        
-    return img0.reshape(shape)
-    
-def to_binary_alpha(img, threshold=120, t0=0,t1=255):
+            distances += d
+    return np.sqrt(distances, out=distances)
+
+def kdtree_palette_indices(x, dist_palette, divisor, k=4, chunk_elements=None):
+    """
+        returns the same indices as the brute force search in
+        nearest_palette_indices, but only checks the k palette colors
+        closest to each row of x according to a k-d tree; the rows that
+        are searched by brute force are processed in chunks of at most
+        chunk_elements floats.
+    """
+    k = min(k, dist_palette.shape[0])
+    tree_distances, candidates = get_palette_tree(dist_palette).query(x, k=k)
+    if k == 1:
+        return candidates.astype(np.intp)
+    # a palette color that is not a candidate may only be as close as the
+    # best candidate, if the k-th candidate is roughly as close as well;
+    # such rows are searched by brute force.
+    safe = tree_distances[:,-1] > tree_distances[:,0]*(1+1e-9) + 1e-9
+    distances = palette_distances(x, dist_palette, divisor, candidates)
+    best = distances.min(axis=1, keepdims=True)
+    indices = np.where(distances == best, candidates, dist_palette.shape[0]).min(axis=1)
+    if not safe.all():
+        indices[~safe] = nearest_palette_indices(x[~safe], dist_palette, divisor, chunk_elements, use_tree=False)
+    return indices
+
+def nearest_palette_indices(colors, dist_palette, divisor=255, chunk_elements=None, use_tree=None):
+    """
+        returns the index of the nearest palette color for each row of colors;
+        ties are resolved in favor of the lower palette index.
+
+        The rows are processed in chunks, so that the temporary distance arrays
+        never hold more than chunk_elements floats. Large palettes are searched
+        using a k-d tree, unless use_tree is given.
+    """
+    if chunk_elements is None:
+        chunk_elements = nearest_palette_chunk_elements
+    dist_palette = np.asarray(dist_palette, dtype=np.float64)
+    if use_tree is None:
+        use_tree = dist_palette.shape[0] >= kdtree_palette_size
+    if use_tree:
+        step = max(1, chunk_elements // 4)
+        indices = np.empty(colors.shape[0], dtype=np.intp)
+        for start in range(0, colors.shape[0], step):
+            x = colors[start:start+step].astype(np.float64)
+            indices[start:start+step] = kdtree_palette_indices(x, dist_palette, divisor, chunk_elements=chunk_elements)
+        return indices
+    step = max(1, chunk_elements // dist_palette.shape[0])
+    indices = np.empty(colors.shape[0], dtype=np.intp)
+    for start in range(0, colors.shape[0], step):
+        x = colors[start:start+step].astype(np.float64)
+        indices[start:start+step] = np.argmin(palette_distances(x, dist_palette, divisor), axis=1)
+    return indices
+
+def rgb_to_colorspace(rgb, colorspace):
+    """
+        whole array version of colorsys.rgb_to_hls, rgb_to_hsv and rgb_to_yiq
+        for rows of float r, g, b values; returns a new array
+    """
+    r, g, b = rgb[:,0], rgb[:,1], rgb[:,2]
+    converted = np.empty(rgb.shape)
+    if colorspace == "yiq":
+        y = 0.30*r + 0.59*g + 0.11*b
+        converted[:,0] = y
+        converted[:,1] = 0.74*(r-y) - 0.27*(b-y)
+        converted[:,2] = 0.48*(r-y) + 0.41*(b-y)
+        return converted
+    maxc = np.maximum(np.maximum(r, g), b)
+    minc = np.minimum(np.minimum(r, g), b)
+    rangec = maxc-minc
+    grey = rangec == 0
+    rangec1 = np.where(grey, 1.0, rangec) # avoids dividing by zero for grey pixels
+    rc = (maxc-r) / rangec1
+    gc = (maxc-g) / rangec1
+    bc = (maxc-b) / rangec1
+    h = np.where(r == maxc, bc-gc, np.where(g == maxc, 2.0+rc-bc, 4.0+gc-rc))
+    h = (h/6.0) % 1.0
+    h[grey] = 0.0
+    converted[:,0] = h
+    if colorspace == "hls":
+        sumc = maxc+minc
+        l = sumc/2.0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            s = np.where(l <= 0.5, rangec / np.where(grey, 1.0, sumc), rangec / np.where(grey, 1.0, 2.0-maxc-minc))
+        converted[:,1] = l
+        converted[:,2] = s
+    else:
+        converted[:,1] = rangec / np.where(grey, 1.0, maxc)
+        converted[:,2] = maxc
+    return converted
+
+colorspaces = ["hls", "hsv", "yiq"]
+
+# scratch memory for the float colors of the pixels of a layer, which is
+# reused for all layers instead of being allocated for each of them
+float_buffer = np.zeros(0)
+
+def get_float_buffer(shape):
+    """
+        returns an uninitialized float array of the given shape that is backed
+        by float_buffer; its contents are only valid until the next call.
+    """
+    global float_buffer
+    size = int(np.prod(shape))
+    if float_buffer.size < size:
+        float_buffer = np.empty(size)
+    return float_buffer[:size].reshape(shape)
+
+def to_distance_space(colors, colorspace="rgb", divisor=255, out=None):
+    """
+        converts the first three channels of each row of colors to the given
+        colorspace, scaled by divisor, and returns them as floats in out or
+        a new array. Colors are returned as they are for the rgb colorspace.
+    """
+    if colorspace not in colorspaces or colors.shape[1] < 3:
+        return colors
+    if out is None:
+        out = np.empty(colors.shape)
+    out[:] = colors
+    out[:,:3] = rgb_to_colorspace(out[:,:3]/divisor, colorspace)*divisor
+    return out
+
+# palette colors converted by to_distance_space, for the most recently used
+# combinations of palette, colorspace and divisor
+dist_palettes = OrderedDict()
+dist_palettes_size = 16
+
+def get_dist_palette(palette, colorspace="rgb", divisor=255):
+    """
+        returns the (cached) float palette colors in the distance space
+    """
+    key = (palette.shape, palette.dtype.str, palette.tobytes(), colorspace, float(divisor))
+    if key in dist_palettes:
+        dist_palettes.move_to_end(key)
+    else:
+        dist_palettes[key] = to_distance_space(palette.astype(np.float64), colorspace, divisor)
+        while len(dist_palettes) > dist_palettes_size:
+            dist_palettes.popitem(last=False)
+    return dist_palettes[key]
+
+def pack_colors(colors):
+    """
+        packs each row of an uint8 array with up to four columns into an uint32
+    """
+    packed = np.zeros(colors.shape[0], dtype=np.uint32)
+    for c in range(colors.shape[1]):
+        packed |= colors[:,c].astype(np.uint32) << (8*c)
+    return packed
+
+def unpack_colors(packed, channels):
+    """
+        inverse of pack_colors
+    """
+    return np.stack([(packed >> (8*c)) & 0xff for c in range(channels)], axis=-1).astype(np.uint8)
+
+# nearest palette indices of colors that have already been looked up, for the
+# most recently used combinations of palette, colorspace and divisor
+palette_memo = OrderedDict()
+palette_memo_size = 16
+palette_memo_colors = 1 << 20
+
+def memoized_palette_indices(packed, palette, divisor=255, colorspace="rgb"):
+    """
+        returns the nearest palette indices for an array of distinct, sorted,
+        packed colors; only colors that have not been seen before with the
+        same palette, colorspace and divisor are actually looked up.
+    """
+    key = (palette.shape, palette.dtype.str, palette.tobytes(), colorspace, float(divisor))
+    if key in palette_memo:
+        known_colors, known_indices = palette_memo[key]
+        palette_memo.move_to_end(key)
+    else:
+        known_colors = np.zeros(0, dtype=np.uint32)
+        known_indices = np.zeros(0, dtype=np.intp)
+    pos = np.searchsorted(known_colors, packed)
+    found = pos < len(known_colors)
+    found[found] = known_colors[pos[found]] == packed[found]
+    indices = np.empty(len(packed), dtype=np.intp)
+    indices[found] = known_indices[pos[found]]
+    missing = packed[~found]
+    if len(missing):
+        dist_palette = get_dist_palette(palette, colorspace, divisor)
+        colors = to_distance_space(unpack_colors(missing, palette.shape[-1]), colorspace, divisor)
+        missing_indices = nearest_palette_indices(colors, dist_palette, divisor)
+        indices[~found] = missing_indices
+        if len(known_colors) + len(missing) > palette_memo_colors:
+            known_colors = known_colors[:0]
+            known_indices = known_indices[:0]
+        known_colors = np.concatenate([known_colors, missing])
+        known_indices = np.concatenate([known_indices, missing_indices])
+        order = np.argsort(known_colors)
+        known_colors = known_colors[order]
+        known_indices = known_indices[order]
+    palette_memo[key] = (known_colors, known_indices)
+    while len(palette_memo) > palette_memo_size:
+        palette_memo.popitem(last=False)
+    return indices
+
+def compile_palette_lut(palette, colorspace="rgb", divisor=255, bits=8):
+    """
+        computes the nearest palette index for the center of each cell of the
+        RGB cube quantized to the given number of bits per channel
+    """
+    shift = 8 - bits
+    levels = ((np.arange(1 << bits) << shift) + ((1 << shift) >> 1)).astype(np.uint8)
+    dist_palette = get_dist_palette(palette, colorspace, divisor)
+    lut = np.empty((1 << bits,)*3, dtype=np.uint8 if len(palette) <= 256 else np.uint16)
+    g, b = [x.ravel() for x in np.meshgrid(levels, levels, indexing="ij")]
+    for r in range(1 << bits):
+        colors = np.stack([np.full(g.shape, levels[r]), g, b], axis=-1)
+        lut[r] = nearest_palette_indices(to_distance_space(colors, colorspace, divisor), dist_palette, divisor).reshape(lut.shape[1:])
+    return lut
+
+# increased whenever compiled lookup tables of older versions of this tool
+# are no longer valid
+palette_lut_version = 1
+
+# palette lookup tables that have been opened by this process
+palette_luts = {}
+
+def get_palette_lut(palette, colorspace="rgb", divisor=255, bits=8, cache_dir=None):
+    """
+        returns the lookup table from quantized RGB values to nearest palette
+        indices, see compile_palette_lut.
+
+        Compiled tables are stored in cache_dir as .npy files named after a
+        hash of palette, colorspace, divisor and bits, and are memory-mapped
+        read-only, so concurrent processes share a single copy.
+    """
+    h = hashlib.sha1(repr((palette_lut_version, palette.shape, palette.dtype.str, colorspace, float(divisor), bits)).encode("utf-8"))
+    h.update(palette.tobytes())
+    key = h.hexdigest()
+    if key in palette_luts:
+        return palette_luts[key]
+    path = None
+    lut = None
+    if cache_dir:
+        path = os.path.join(os.path.expanduser(cache_dir), "palette-luts", key + ".npy")
+        if os.path.exists(path):
+            try:
+                lut = np.load(path, mmap_mode="r")
+            except (OSError, ValueError):
+                print(f"WARNING: ignoring broken palette lookup table '{path}'.")
+    if lut is None:
+        lut = compile_palette_lut(palette, colorspace, divisor, bits)
+        if path is not None:
+            tmp = None
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(path))
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, lut)
+                os.replace(tmp, path)
+                lut = np.load(path, mmap_mode="r")
+            except OSError as e:
+                print(f"WARNING: could not store palette lookup table '{path}': {e}")
+                if tmp is not None and os.path.exists(tmp):
+                    os.remove(tmp)
+    palette_luts[key] = lut
+    return lut
+
+def to_nearest_palette(img, palette = ega_palette, divisor=255,colorspace="rgb",method="unique",lut_bits=8,cache_dir=None):
     shape = img.shape
     channels = shape[-1]
-    dims = shape[:-1]
-    if channels == ega_palette.shape[-1] + 1:
+    if channels == palette.shape[-1] + 1:
         has_alpha = True
     else:
         has_alpha = False
-    linear = 1
-    for x in dims:
-        linear *= x
-    img0 = np.copy(img.reshape((linear, channels)))
+    img0 = np.copy(img.reshape((-1, channels)))
     if has_alpha:
-        for i in range(linear):
-            img0[i][-1] = t0 if img0[i][-1] < threshold else t1
-            
+        colors = img0[:,:-1]
+    else:
+        colors = img0
+    if method == "lut" and (colors.shape[1] != 3 or colors.dtype != np.uint8):
+        print("WARNING: lookup tables only work for RGB palettes, using method 'unique'.")
+        method = "unique"
+    if method == "lut":
+        if cache_dir is None:
+            cache_dir = options["cache-dir"]
+        lut = get_palette_lut(palette, colorspace, divisor, lut_bits, cache_dir)
+        shift = 8 - lut_bits
+        indices = lut[colors[:,0] >> shift, colors[:,1] >> shift, colors[:,2] >> shift]
+    elif method == "unique" and colors.dtype == np.uint8 and colors.shape[1] <= 4:
+        unique_colors, inverse = np.unique(pack_colors(colors), return_inverse=True)
+        indices = memoized_palette_indices(unique_colors, palette, divisor, colorspace)[inverse]
+    else:
+        dist_palette = get_dist_palette(palette, colorspace, divisor)
+        dist_colors = to_distance_space(colors, colorspace, divisor, out=get_float_buffer(colors.shape))
+        indices = nearest_palette_indices(dist_colors, dist_palette, divisor)
+    if has_alpha:
+        img0[:,:-1] = palette[indices]
+    else:
+        img0[:] = palette[indices]
+
     return img0.reshape(shape)
     
-def fix_transparent_color(img, threshold=0, full_neighborhood=True):
-    shape = img.shape
-    channels = shape[-1]
-    if not (channels == ega_palette.shape[-1] + 1):
+def has_alpha(img):
+    """ whether the pixel array has an alpha channel, i.e. is LA or RGBA """
+    return len(img.shape) == 3 and img.shape[-1] in (2, 4)
+
+def apply_luts(img, luts):
+    """
+        applies point ops to the uint8 pixel array img in place and returns
+        it; luts maps channel indices, where -1 is alpha, to lookup tables
+        with 256 entries that give the new value for each old value.
+    """
+    for c, lut in luts.items():
+        channel = img[..., c]
+        channel[...] = lut[channel]
+    return img
+
+def binary_alpha_luts(img, threshold=120, t0=0, t1=255):
+    """ returns the lookup tables of to_binary_alpha for the pixel array img """
+    if not has_alpha(img):
+        return {}
+    return {-1: np.where(np.arange(256) < threshold, t0, t1).astype(np.uint8)}
+
+def to_binary_alpha(img, threshold=120, t0=0,t1=255):
+    return apply_luts(np.copy(img), binary_alpha_luts(img, threshold, t0, t1))
+    
+# transparent pixels are bled in horizontal strips of about this many pixels
+bleed_strip_pixels = 1 << 18
+
+def fix_transparent_color(img, threshold=0, full_neighborhood=True, iterations=1):
+    """
+        sets the color of transparent pixels next to non-transparent ones to
+        the alpha weighted mean color of those neighbors; each further
+        iteration bleeds the colors of the pixels set by the previous one
+        another pixel outward, weighting them equally.
+        Transparent pixels become fully transparent.
+    """
+    if not has_alpha(img):
         print(f"WARNING: fix_transparent_color on layer without alpha (shape={img.shape})")
         return img 
     
-    mask = np.expand_dims((img[:,:,-1] <= threshold).astype(np.uint8), axis=-1)
-    inv_mask = 1 - mask
-    img0 = (img*inv_mask).astype(np.uint64) # zero out all transparent elements
-    #weight color channels
-    img0[:,:,:-1] *= np.expand_dims(img0[:,:,-1],axis=-1)
-    #now, sum up
-    pixel_sums = np.copy(img0).astype(np.uint64)
-    pixel_sums[1:,:,:] += img0[:-1,:,:] # add values of top row
-    pixel_sums[:-1,:,:] += img0[1:,:,:] # add values of bottom row
-    pixel_sums[:,1:,:] += img0[:,:-1,:] # add values of left column
-    pixel_sums[:,:-1,:] += img0[:,1:,:] # add values of right column
+    h, w = img.shape[:2]
+    known = img[:,:,-1] > threshold
+    output = img * np.expand_dims(known, axis=-1).astype(img.dtype)
     if full_neighborhood:
-        pixel_sums[1:,1:,:] += img0[:-1,:-1,:] # add values of top-left
-        pixel_sums[:-1,1:,:] += img0[1:,:-1,:] # add values of bottom-left
-        pixel_sums[1:,:-1,:] += img0[:-1,1:,:] # add values of top-right
-        pixel_sums[:-1,:-1,:] += img0[1:,1:,:] # add values of bottom-right
-    #force the denumerator to be >= 1
-    np.vectorize(lambda x: x if x > 0 else 1)(pixel_sums[:,:,-1])
-    #calculate weighted average
-    pixel_sums = np.round(pixel_sums / (np.expand_dims(pixel_sums[:,:,-1],axis=-1))).astype(np.uint8)
-    pixel_sums[:,:,-1] = 0 # force alpha to be transparent
-    return (img*inv_mask) + (pixel_sums*mask)
+        offsets = [(-1,-1),(-1,0),(-1,1),(0,-1),(0,1),(1,-1),(1,0),(1,1)]
+    else:
+        offsets = [(-1,0),(0,-1),(0,1),(1,0)]
+    sources = known
+    weights = img[:,:,-1].astype(np.uint32)
+    rows = max(1, bleed_strip_pixels // max(w, 1))
+    for _ in range(iterations):
+        bled = np.zeros_like(known)
+        for y0 in range(0, h, rows):
+            y1 = min(y0 + rows, h)
+            # the transparent pixels of the strip next to a source pixel
+            halo = np.pad(sources[max(y0-1,0):y1+1], ((int(y0 == 0), int(y1 == h)), (1,1)))
+            frontier = np.zeros((y1-y0, w), dtype=bool)
+            for dy, dx in offsets:
+                frontier |= halo[1+dy:1+dy+y1-y0, 1+dx:1+dx+w]
+            frontier &= ~known[y0:y1]
+            fy, fx = np.nonzero(frontier)
+            if len(fy) == 0:
+                continue
+            fy += y0
+            color_sums = np.zeros((len(fy), img.shape[-1]-1), dtype=np.uint32)
+            weight_sums = np.zeros(len(fy), dtype=np.uint32)
+            for dy, dx in offsets:
+                ny = np.clip(fy + dy, 0, h-1)
+                nx = np.clip(fx + dx, 0, w-1)
+                inside = (ny == fy + dy) & (nx == fx + dx)
+                weight = weights[ny, nx] * (sources[ny, nx] & inside)
+                color_sums += output[ny, nx, :-1] * np.expand_dims(weight, axis=-1)
+                weight_sums += weight
+            output[fy, fx, :-1] = np.round(color_sums / np.expand_dims(weight_sums, axis=-1))
+            bled[fy, fx] = True
+        if not bled.any():
+            break
+        known = known | bled
+        sources = bled
+        weights = np.ones_like(weights)
+    return output
     
+def tile_view(img, width, height, step_x, step_y, x0=0, y0=0, tiles_nX=1, tiles_nY=1):
+    """
+        returns a view of the tiles_nX x tiles_nY tiles of size width x height
+        in img, whose top left corners are step_x and step_y pixels apart
+        starting at (x0,y0), with the axes (tile row, y, tile column, x, ...)
+    """
+    strides = img.strides
+    return np.lib.stride_tricks.as_strided(img[y0:,x0:],
+                                           (tiles_nY, height, tiles_nX, width) + img.shape[2:],
+                                           (strides[0]*step_y, strides[0], strides[1]*step_x, strides[1]) + strides[2:],
+                                           writeable=False)
+
 def rm_tileset_spacing(width,height,border,space, img):
     tiles_nX = int((img.shape[1]+space) / (width+2*border+space))
     tiles_nY = int((img.shape[0]+space) / (height+2*border+space))
     if tiles_nX == 0 or tiles_nY == 0:
         print(f"WARNING: Not even a full tile in image! (shape={img.shape}; tile={width}x{height})")
         return img
-    new_img = np.zeros((tiles_nY * height,
-                        tiles_nX * width)
-                       + img.shape[2:],dtype=np.uint8)
-    for y in range(tiles_nY):
-        for x in range(tiles_nX):
-            #copy tiles
-            x0 = x*width
-            x1 = x*(width + 2*border + space) + border
-            y0 = y*height
-            y1 = y*(height + 2*border + space) + border
-            new_img[y0:y0+height,x0:x0+width] = img[y1:y1+height, x1:x1+width]
-            
-    return new_img
+    tiles = tile_view(img, width, height, width + 2*border + space, height + 2*border + space,
+                      border, border, tiles_nX, tiles_nY)
+    return tiles.astype(np.uint8).reshape((tiles_nY * height, tiles_nX * width) + img.shape[2:])
     
 
 def add_tileset_spacing(width,height,border,space, img):
@@ -754,44 +2407,28 @@ def add_tileset_spacing(width,height,border,space, img):
     if tiles_nX == 0 or tiles_nY == 0:
         print(f"WARNING: Not even a full tile in image! (shape={img.shape}; tile={width}x{height})")
         return img
-    new_img = np.zeros((tiles_nY * (height + 2*border + space) - space,
-                        tiles_nX *(width + 2*border + space) - space)
+    tiles = tile_view(img, width, height, width, height, 0, 0, tiles_nX, tiles_nY)
+    # the borders repeat the outermost pixels of each tile, the spacing
+    # after each tile stays transparent
+    new_img = np.zeros((tiles_nY, height + 2*border + space, tiles_nX, width + 2*border + space)
                        + img.shape[2:],dtype=np.uint8)
-    for y in range(tiles_nY):
-        for x in range(tiles_nX):
-            #copy tiles
-            x0 = x*width
-            x1 = x*(width + 2*border + space) + border
-            y0 = y*height
-            y1 = y*(height + 2*border + space) + border
-            new_img[y1:y1+height, x1:x1+width] = img[y0:y0+height,x0:x0+width]
-            #add borders
-            for b in range(border):
-                b += 1
-                #top
-                new_img[y1-b, x1:x1+width] = img[y0,x0:x0+width]
-                #bottom
-                new_img[y1+height+b-1, x1:x1+width] = img[y0+height-1,x0:x0+width]
-                #left
-                new_img[y1:y1+height, x1-b] = img[y0:y0+height,x0]
-                #right
-                new_img[y1:y1+height, x1+width+b-1] = img[y0:y0+height,x0+width-1]
-            if border > 0:
-                xpdim = lambda x: np.expand_dims(np.expand_dims(x,axis=0),axis=0)
-                #corners
-                #top left
-                new_img[y1-border:y1,x1-border:x1] = xpdim(img[y0,x0])
-                #bottom left
-                new_img[y1+height:y1+height+border,x1-border:x1] = xpdim(img[y0+height-1,x0])
-                #top right
-                new_img[y1-border:y1,x1+width:x1+width+border] = xpdim(img[y0,x0+width-1])
-                #bottom right
-                new_img[y1+height:y1+height+border,x1+width:x1+width+border] = xpdim(img[y0+height-1,x0+width-1])
-                    
-            
-    return new_img
+    pad = [(0,0), (border,border), (0,0), (border,border)] + [(0,0)] * len(img.shape[2:])
+    new_img[:, :height + 2*border, :, :width + 2*border] = np.pad(tiles, pad, mode="edge")
+    new_img = new_img.reshape((tiles_nY * (height + 2*border + space),
+                               tiles_nX * (width + 2*border + space)) + img.shape[2:])
+    # there is no spacing after the last tiles
+    return new_img[:new_img.shape[0]-space, :new_img.shape[1]-space]
     
 
+def get_option(task, name):
+    """
+        returns the value of the global option name, unless it is overridden
+        by the task
+    """
+    if type(task) == dict and name in task:
+        return task[name]
+    return options[name]
+
 def transform_input_output_to_dict(x):
     if type(x) == dict:
         return x
@@ -845,11 +2482,18 @@ def transform_ops(x):
             ops.append((k, params))
     return ops
 
-def get_palette(palette):
+def get_palette(palette, search_path=""):
     if str(palette) in named_palettes:
         return named_palettes[str(palette)]
     if type(palette) == np.ndarray:
         return palette
+    if type(palette) == str:
+        path = find_palette_file(palette, search_path)
+        if path is None and os.path.isfile(palette):
+            path = palette
+        if path is None:
+            raise ValueError(f"Palette '{palette}' is neither predefined nor found in the palette directories.")
+        return load_palette_file(path)
     return np.array(palette, dtype=np.uint8)
     
 def get_matcher_from_str(exp):
@@ -892,36 +2536,232 @@ def get_image_filter_map(filter_exp):
         return filter_exp
     if type(filter_exp) == list:
         q = [get_image_filter_map(x) for x in filter_exp]
-        return lambda x,q=q: any([f(x) for f in q])
+        return lambda x,q=q: any(f(x) for f in q)
     if type(filter_exp) == str:
         return get_matcher_from_str(filter_exp)
+
+# compiled images and layers filters, keyed by their filter expressions
+compiled_filters = OrderedDict()
+compiled_filters_size = 256
+
+# results of compiled filters, keyed by (filter key, name, layer position)
+filter_results = {}
+
+def filter_key(filter_exp):
+    """ returns a hashable key for an images or layers filter expression """
+    if type(filter_exp) == list:
+        return ("list",) + tuple([filter_key(x) for x in filter_exp])
+    return (type(filter_exp).__name__, filter_exp)
+
+def compiled_filter(kind, filter_exp):
+    """
+        returns (key, filter function) of an images or layers filter
+        expression, which is compiled only once
+    """
+    key = (kind, filter_key(filter_exp))
+    if key in compiled_filters:
+        compiled_filters.move_to_end(key)
+    else:
+        if kind == "images":
+            compiled_filters[key] = get_image_filter_map(filter_exp)
+        else:
+            compiled_filters[key] = get_layer_filter_map(filter_exp)
+        while len(compiled_filters) > compiled_filters_size:
+            compiled_filters.popitem(last=False)
+    return key, compiled_filters[key]
+
+def filter_matches(key, fn, pos, name):
+    """
+        returns whether the compiled filter fn with the given key matches the
+        layer at position pos with the given name; for images filters, pos is None
+    """
+    memo = (key, name, pos)
+    if memo not in filter_results:
+        filter_results[memo] = bool(fn(name) if pos is None else fn(pos, name))
+    return filter_results[memo]
         
-def merge_layers(layers):
-    """
-        merges a list of pixel arrays and returns the result as
-        RGBA array
-    """
-    layers = [x if len(x.shape) == 3 and x.shape[-1] == 4 else npa_convert_to_rgba(x) for x in layers ] 
-    w = max(map(lambda x: x.shape[1], layers))
-    h = max(map(lambda x: x.shape[0], layers))
-    output = np.zeros((h,w,4),dtype=np.float)
-    for l in layers:
-        h,w = l.shape[:2]
-        opaqueness = output[0:h,0:w,-1:]
-        see_through_left = 255 - opaqueness
-        output[0:h,0:w,:-1] = (opaqueness * output[0:h,0:w,:-1] + see_through_left * l[0:h,0:w,:-1]) / 255
-        output[0:h,0:w,-1:] = opaqueness + see_through_left * l[0:h,0:w,-1:] / 255
-    return (output + .5).astype(np.uint8)
+# layers are blended in horizontal strips of about this many pixels, which
+# bounds the size of the temporary arrays
+composite_strip_pixels = 1 << 18
+
+# composites are held in fixed point: each channel value v is stored as
+# v*256 in an uint16, so fx_opaque is the alpha value of opaque pixels
+fx_opaque = 255 << 8
+
+def blend_strip(state, l, opacity=255):
+    """
+        blends the RGBA pixel array l with the given opacity (0..255) below
+        the fixed point composite state of the same size; transparent pixels
+        of l leave the composite as it is, so blending a layer does not
+        depend on how far it is cropped
+    """
+    alpha = state[:,:,3:].astype(np.uint32)
+    if alpha.min() == fx_opaque:
+        # nothing below an opaque composite shows through
+        return
+    l_alpha = layer_alpha(l, opacity)
+    shows = l_alpha != 0
+    if not shows.any():
+        return
+    see_through = fx_opaque - alpha
+    l = l.astype(np.uint32)
+    # at most fx_opaque*fx_opaque + fx_opaque//2 < 2**32
+    color = alpha * state[:,:,:-1] + see_through * (l[:,:,:-1] << 8)
+    np.copyto(state[:,:,:-1], (color + fx_opaque//2) // fx_opaque, casting="unsafe", where=shows)
+    state[:,:,-1:] = alpha + (see_through * l_alpha + 127) // 255
+
+def layer_alpha(l, opacity=255):
+    """ returns the alpha channel of l scaled by the opacity (0..255) """
+    alpha = l[:,:,-1:].astype(np.uint32)
+    if opacity != 255:
+        alpha = (alpha * opacity + 127) // 255
+    return alpha
+
+def layer_placements(layers):
+    """
+        returns (pixels, x, y, opacity) of the visible, non-empty layers,
+        where the pixels are RGBA arrays and the opacity is in 0..255
+    """
+    placed = []
+    for img in layers:
+        x, y, opacity, visible = layer_attributes(img)
+        if not visible or is_empty(img):
+            continue
+        l = get_pixels(img)
+        if not (len(l.shape) == 3 and l.shape[-1] == 4):
+            l = npa_convert_to_rgba(l)
+        placed.append((l, x, y, min(max(int(opacity*255+.5),0),255)))
+    return placed
+
+def blend_layers(layers, state, x0, y0, empty=False):
+    """
+        blends the placed layers below the fixed point composite state of the
+        canvas area that starts at (x0,y0); only the areas that are covered
+        by a layer take part in blending
+    """
+    h,w = state.shape[:2]
+    for l, x, y, opacity in layers:
+        top, bottom = max(y, y0), min(y+l.shape[0], y0+h)
+        left, right = max(x, x0), min(x+l.shape[1], x0+w)
+        if top >= bottom or left >= right:
+            continue
+        l = l[top-y:bottom-y, left-x:right-x]
+        area = state[top-y0:bottom-y0, left-x0:right-x0]
+        if empty:
+            # blending onto a transparent black canvas copies the layer
+            # except for the color of its transparent pixels
+            alpha = layer_alpha(l, opacity)
+            area[:,:,:-1] = l[:,:,:-1].astype(np.uint16) << 8
+            area[:,:,:-1] *= alpha != 0
+            area[:,:,-1:] = alpha << 8
+            empty = False
+        else:
+            blend_strip(area, l, opacity)
+
+def fx_to_uint8(state):
+    """ rounds a fixed point composite to an RGBA array """
+    return ((state + 128) >> 8).astype(np.uint8)
+
+def merge_layers(layers, area=None):
+    """
+        merges a list of layers or pixel arrays and returns the result as
+        RGBA array; area (x,y,w,h) is the part of the canvas that is
+        returned, and defaults to the canvas that holds all layers
+    """
+    if area is None:
+        area = (0, 0) + canvas_size(layers)
+    x0, y0, w, h = area
+    placed = layer_placements(layers)
+    output = np.empty((h,w,4),dtype=np.uint8)
+    rows = max(1, composite_strip_pixels // max(w,1))
+    for s0 in range(0, h, rows):
+        state = np.zeros((min(rows,h-s0),w,4),dtype=np.uint16)
+        blend_layers(placed, state, x0, y0+s0, empty=True)
+        output[s0:s0+rows] = fx_to_uint8(state)
+    return output
+
+def composite_layers(layers, output=None):
+    """
+        blends a list of layers or pixel arrays below the given partial
+        composite of the canvas, and returns the composite in fixed point
+    """
+    w, h = canvas_size(layers)
+    empty = output is None
+    if output is None:
+        output = np.zeros((h,w,4),dtype=np.uint16)
+    elif output.shape[:2] != (h,w):
+        # blending starts with a transparent black canvas, so a partial
+        # composite may be extended to a larger canvas by zeros
+        h, w = max(h,output.shape[0]), max(w,output.shape[1])
+        output0 = np.zeros((h,w,4),dtype=np.uint16)
+        output0[:output.shape[0],:output.shape[1]] = output
+        output = output0
+    placed = layer_placements(layers)
+    rows = max(1, composite_strip_pixels // max(w,1))
+    for s0 in range(0, h, rows):
+        blend_layers(placed, output[s0:s0+rows], 0, s0, empty)
+    return output
+
+# partial composites of the unmodified top layers of recently merged layer
+# stacks, keyed by the contents of those layers, so they are reused by later
+# tasks that load the same files
+composites = OrderedDict()
+composites_size = 4
+# images are also merged by the background writes of handed over images
+composites_lock = threading.Lock()
+
+def content_key(layer):
+    """
+        returns what determines the contribution of an unmodified layer to a
+        composite across tasks: the path of its file, the CRC32 and size of
+        its zip entry, its offset, opacity, visibility and the area it spans
+    """
+    zf, entry = layer.source
+    info = zf.getinfo(entry)
+    path = normal_path(zf.filename) if zf.filename else None
+    return (path, entry, info.CRC, info.file_size, layer.x, layer.y, layer.opacity, layer.visible, layer.size)
+
+def merge_layers_cached(imgs, w=0, h=0):
+    """
+        merges a list of layers like merge_layers onto a canvas of at least
+        size (w,h); the composite of the longest run of unmodified layers at
+        the top of the stack is cached and reused.
+
+        The blending is not associative, so only composites of the layers
+        above a modified layer can be reused, but not of those below it.
+    """
+    w, h = canvas_size(imgs, (w,h))
+    clean = 0
+    while clean < len(imgs) and not imgs[clean].dirty:
+        clean += 1
+    if clean == 0:
+        return merge_layers(imgs, (0,0,w,h))
+    key = tuple([content_key(img) for img in imgs[:clean]])
+    with composites_lock:
+        output = composites.get(key)
+        if output is not None:
+            composites.move_to_end(key)
+    if output is None:
+        output = composite_layers(imgs[:clean])
+        with composites_lock:
+            composites[key] = output
+            while len(composites) > composites_size:
+                composites.popitem(last=False)
+    if clean < len(imgs):
+        output = composite_layers(imgs[clean:], np.copy(output))
+    merged = np.zeros((h,w,4),dtype=np.uint8)
+    merged[:output.shape[0],:output.shape[1]] = fx_to_uint8(output)
+    return merged
     
 def get_center(x):
     """ convert x to value for center parameter in transformations """
     if type(x) == list:
         if len(x) == 2:
-            return np.array(x, dtype=np.float)
+            return np.array(x, dtype=np.float64)
         else:
             return None
     elif type(x) == str:
-        return np.array(x.split(","), dtype=np.float)
+        return np.array(x.split(","), dtype=np.float64)
     else:
         return None
 
@@ -930,122 +2770,217 @@ def get_layer_filter_map(filter_exp):
         return filter_exp
     if type(filter_exp) == list:
         q = [get_layer_filter_map(x) for x in filter_exp]
-        return lambda x,y,q=q: any([f(x,y) for f in q])
+        return lambda x,y,q=q: any(f(x,y) for f in q)
     if type(filter_exp) == str:
         q = get_matcher_from_str(filter_exp)
         return lambda x,y,q=q: q(y)
     if type(filter_exp) == int:
         return lambda x,y,q=filter_exp: x == q
 
-def get_image_layers(data, images, layers):
+def get_image_layers(data, images, layers, discard=[]):
+    """
+        returns (image, layer key, layer position) of the layers that match
+        the filters, from top to bottom; layers that are selected by one of
+        the (images, layers) filters in discard are left out
+    """
     img_layer = []
-    img_filter = get_image_filter_map(images)
-    layer_filter = get_layer_filter_map(layers)
+    fkey, img_filter = compiled_filter("images", images)
     for k in data:
-        if img_filter(k):
-            for nbr,l in enumerate(data[k]):
-                name, _ = l
-                if layer_filter(len(data[k])-nbr-1,name):
-                    img_layer.append((k, nbr))
+        if filter_matches(fkey, img_filter, None, k):
+            for key,pos in data[k].select(layers):
+                img_layer.append((k, key, pos))
+    if discard:
+        removed = set()
+        for d_images, d_layers in discard:
+            removed.update([(k, key) for k,key,_ in get_image_layers(data, d_images, d_layers)])
+        for k,key,pos in img_layer:
+            if (k, key) in removed:
+                print(f"    ..skipping layer '{k}':{pos} labelled '{data[k][key].name}', it is removed later")
+        img_layer = [(k,key,pos) for k,key,pos in img_layer if not (k, key) in removed]
     return img_layer
 
-def work(task):
+def decode_image_layers(data, images, layers, workers=1, discard=[]):
+    """
+        like get_image_layers, but the selected layers are decoded in parallel
+        beforehand
+    """
+    img_layer = get_image_layers(data, images, layers, discard)
+    decode_layers([data[k][key] for k,key,_ in img_layer], workers)
+    return img_layer
+
+# ops that change each pixel on its own
+pixel_local_ops = ["to-nearest-palette", "to-binary-alpha"]
+
+# ops that change selected layers on their own, but neither add, remove
+# nor reorder layers
+layer_local_ops = pixel_local_ops + ["rotate-layers", "flip-layers", "move-layers",
+                                     "resize-layers", "fix-transparent-color",
+                                     "add-tileset-spaces", "rm-tileset-spaces"]
+
+def same_selection(params0, params1):
+    """ whether two ops select the same layers of the same images """
+    return (filter_key(params0["images"]) == filter_key(params1["images"]) and
+            filter_key(params0["layers"]) == filter_key(params1["layers"]))
+
+def plan_ops(ops):
+    """
+        returns the steps (fused, discard) that carry out the list of
+        (op, params) in order.
+
+        fused is a list of (op, params); adjacent per pixel ops on the same
+        layers are fused into a single step, which makes one pass over each
+        layer.
+        discard is a list of (images, layers) filters: if only layer local
+        ops lie between a layer local step and the next rm-layers, then the
+        layer stack is the same for both, and the step may skip the layers
+        that rm-layers is going to remove.
+    """
+    steps = []
+    for op, params in ops:
+        if (steps and op in pixel_local_ops and steps[-1][0][-1][0] in pixel_local_ops
+                  and same_selection(steps[-1][0][-1][1], params)):
+            steps[-1][0].append((op, params))
+        else:
+            steps.append(([(op, params)], []))
+    for nbr, (fused, discard) in enumerate(steps):
+        if not fused[0][0] in layer_local_ops:
+            continue
+        for later, _ in steps[nbr+1:]:
+            op, params = later[0]
+            if op == "rm-layers":
+                discard.append((params["images"], params["layers"]))
+            if not op in layer_local_ops:
+                break
+    return steps
+
+def explain_plan(steps):
+    """ prints the steps that plan_ops returned """
+    for nbr, (fused, discard) in enumerate(steps):
+        print(f"STEP {nbr+1}: {' + '.join([op for op,_ in fused])}")
+        params = fused[0][1]
+        if "images" in params:
+            print(f"  images = {params['images']}")
+            print(f"  layers = {params['layers']}")
+        if len(fused) > 1:
+            print(f"  ..a single pass over each layer")
+        for images, layers in discard:
+            print(f"  ..skipping layers removed by rm-layers: images = {images}, layers = {layers}")
+
+def pixel_op(task, op, params):
+    """
+        returns the per pixel function of a per pixel op, see run_pixel_ops
+    """
+    if op == 'to-nearest-palette':
+        p = get_palette(params["palette"], get_option(task, "palette-path"))
+        divisor = float(params["divisor"])
+        space = params["colorspace"]
+        method = params["method"]
+        lut_bits = min(max(int(params["lut-bits"]),1),8)
+        cache_dir = get_option(task, "cache-dir")
+        # layers are RGBA, so lookup tables need a RGB palette; this is
+        # checked once here instead of for every strip
+        if method == "lut" and p.shape[-1] != 3:
+            print("WARNING: lookup tables only work for RGB palettes, using method 'unique'.")
+            method = "unique"
+        return lambda x: to_nearest_palette(x, palette=p,divisor=divisor,colorspace=space,method=method,lut_bits=lut_bits,cache_dir=cache_dir)
+    elif op == 'to-binary-alpha':
+        thr = int(params["threshold"])
+        t0 = int(params["t0"])
+        t1 = int(params["t1"])
+        return lambda x: apply_luts(x, binary_alpha_luts(x,thr,t0,t1))
+
+def work(task, keep={}):
+    """
+        runs the ops of the task; the images that are stored to a path in
+        keep are handed over to the given number of loads by later tasks
+    """
     global data
     data = {}
+    workers = get_option(task, "workers")
     i = transform_input_output_to_dict(task["input"])
     o = transform_input_output_to_dict(task["output"])
+    steps = plan_ops(transform_ops(task["ops"]))
+    if as_boolean(get_option(task, "explain")):
+        print(f"PLAN: {i} -> {o}")
+        explain_plan(steps)
+        return
     for k in i:
         print(f"LOAD: '{i[k]}' as image '{k}'.")
-        data[k] = load_ora(i[k])
+        data[k] = load_ora(i[k], get_option(task, "cache-dir"), get_option(task, "layer-cache-size"))
         
-    for op, params in transform_ops(task["ops"]):
-        print(f"OP: {op}")
-        for k in params:
-            print(f"  {k} = {params[k]}")
-        if op == 'to-nearest-palette':
-            p = get_palette(params["palette"])
-            space = params["colorspace"]
-            for k,idx in get_image_layers(data,params["images"],params["layers"]):
-                lbl,img = data[k][idx]
-                print(f"    ..applying to layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                img = to_nearest_palette(img, palette=p,divisor=float(params["divisor"]),colorspace=space)
-                data[k][idx] = (lbl, img)
-        elif op == 'to-binary-alpha':
-            thr = int(params["threshold"])
-            t0 = int(params["t0"])
-            t1 = int(params["t1"])
-            for k,idx in get_image_layers(data,params["images"],params["layers"]):
-                lbl,img = data[k][idx]
-                print(f"    ..applying to layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                img = to_binary_alpha(img,thr,t0,t1)
-                data[k][idx] = (lbl, img)
+    for fused, discard in steps:
+        for op, params in fused:
+            print(f"OP: {op}")
+            for k in params:
+                print(f"  {k} = {params[k]}")
+        op, params = fused[0]
+        if op in pixel_local_ops:
+            fns = [pixel_op(task, op, params) for op, params in fused]
+            for k,key,pos in decode_image_layers(data,params["images"],params["layers"],workers,discard):
+                layer = data[k][key]
+                print(f"    ..applying to layer '{k}':{pos} labelled '{layer.name}'")
+                map_layer_pixel_ops(layer, fns)
         elif op == "rm-layers":
             remove_layers = get_image_layers(data,params["images"],params["layers"])
-            for k,idx in sorted(set(remove_layers),key=lambda x: (x[0],-x[1])):
-                print(f"    ..dropping layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                data[k] = data[k][:idx] + data[k][idx+1:]
+            for k,key,pos in sorted(remove_layers,key=lambda x: (x[0],x[2])):
+                print(f"    ..dropping layer '{k}':{pos} labelled '{data[k][key].name}'")
+                data[k].remove(key)
         elif op == "cp-layers":
             copied_layers = []
-            for k,idx in get_image_layers(data,params["images"],params["layers"]):
-                copied_layers.append(data[k][idx])
-                print(f"    ..copying layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
+            for k,key,pos in get_image_layers(data,params["images"],params["layers"]):
+                copied_layers.append(data[k][key].copy())
+                print(f"    ..copying layer '{k}':{pos} labelled '{data[k][key].name}'")
             target_img = params["target"]
             if copied_layers == []:
                 print(f"    ..WARNING: no layer has been copied")
             if not target_img in data:
-                    data[target_img] = copied_layers
+                data[target_img] = Document(copied_layers)
             else:
-                data[target_img] = copied_layers + data[target_img]
+                for layer in reversed(copied_layers):
+                    data[target_img].add(layer)
         elif op == 'rotate-layers':
             center = get_center(params["center"])
             resize = as_boolean(params["resize"])
             angle = float(params["angle"])
             mode = str(params["mode"])
-            cval = np.array(params["cval"],dtype=np.float)
+            cval = np.array(params["cval"],dtype=np.float64)
             clip = as_boolean(params["clip"])
             order = int(params["order"])
-            for k,idx in get_image_layers(data,params["images"],params["layers"]):
-                lbl,img = data[k][idx]
-                print(f"    ..applying to layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                img = sit.rotate(img, angle, resize=resize, center=center,mode=mode, order=order, clip=clip, cval=cval, preserve_range=True)
-                img = img.astype(np.uint8)
-                data[k][idx] = (lbl, img)
+            for k,key,pos in get_image_layers(data,params["images"],params["layers"],discard):
+                layer = data[k][key]
+                print(f"    ..applying to layer '{k}':{pos} labelled '{layer.name}'")
+                matrix, size = rotation_transform(angle, extent(layer), center, resize)
+                add_transform(layer, matrix, size, (order, mode, float(cval), clip))
         elif op == 'flip-layers':
             axis = 1 if str(params["axis"]) == "horizontal" else 0
-            for k,idx in get_image_layers(data,params["images"],params["layers"]):
-                    lbl,img = data[k][idx]
-                    print(f"    ..applying to layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                    img = np.flip(img, axis=axis)
-                    data[k][idx] = (lbl, img)
+            for k,key,pos in get_image_layers(data,params["images"],params["layers"],discard):
+                layer = data[k][key]
+                print(f"    ..applying to layer '{k}':{pos} labelled '{layer.name}'")
+                # layers are flipped at the center of the area they span
+                add_transform(layer, flip_transform(axis, extent(layer)), extent(layer))
         elif op == 'merge-layers':
             layer_name = params["name"]
-            target_img_layers = get_image_layers(data,params["images"],params["layers"])
-            for k in set([img for img,_ in target_img_layers]):
-                layers = [idx for img,idx in target_img_layers if img == k]
-                for idx in layers:
-                    print(f"    ..including layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                merged = merge_layers([data[k][idx][1] for idx in layers])
-            data[k] = [(layer_name, merged)] + [data[k][idx] for idx in range(len(data[k])) if not idx in layers]
+            target_img_layers = decode_image_layers(data,params["images"],params["layers"],workers,discard)
+            for k in [k for k in data if any([img == k for img,_,_ in target_img_layers])]:
+                keys = [key for img,key,_ in target_img_layers if img == k]
+                for img,key,pos in target_img_layers:
+                    if img == k:
+                        print(f"    ..including layer '{k}':{pos} labelled '{data[k][key].name}'")
+                merged = merge_layer_area(layer_name, [data[k][key] for key in keys])
+                for key in keys:
+                    data[k].remove(key)
+                data[k].add(merged)
         elif op == 'move-layers':
             x = int(params["x"])
             y = int(params["y"])
-            target_img_layers = get_image_layers(data,params["images"],params["layers"])
-            for k,idx in target_img_layers:
-                print(f"    ..moving layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                name,img = data[k][idx]
-                if x < 0:
-                    img = img[:,-x:]
-                elif x > 0:
-                    shape0 = list(img.shape)
-                    shape0[1] = x
-                    img = np.concatenate([np.zeros(shape0, dtype=np.uint8), img],axis=1)
-                if y < 0:
-                    img = img[-y:,:]
-                elif y > 0:
-                    shape0 = list(img.shape)
-                    shape0[0] = y
-                    img = np.concatenate([np.zeros(shape0, dtype=np.uint8), img],axis=0)
-                data[k][idx] = (name, img)
+            target_img_layers = get_image_layers(data,params["images"],params["layers"],discard)
+            for k,key,pos in target_img_layers:
+                layer = data[k][key]
+                print(f"    ..moving layer '{k}':{pos} labelled '{layer.name}'")
+                w, h = extent(layer)
+                # parts that are moved beyond the top or left canvas border
+                # are cut off
+                add_transform(layer, translation(x, y), (max(w + x, 0), max(h + y, 0)))
         elif op == 'resize-layers':
             if params["w"] == "keep-size":
                 x = None
@@ -1062,24 +2997,30 @@ def work(task):
             clip = params["clip"]
             cval = params["cval"]
             order = params["order"]
-            target_img_layers = get_image_layers(data,params["images"],params["layers"])
-            for k,idx in target_img_layers:
-                print(f"    ..resizing layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                name,img = data[k][idx]
+            if not mode in ["crop", "interpolation"]:
+                print(f"!!WARNING!! resize mode {mode} is unknown, using 'crop'.")
+                mode = "crop"
+            target_img_layers = get_image_layers(data,params["images"],params["layers"],discard)
+            for k,key,pos in target_img_layers:
+                layer = data[k][key]
+                print(f"    ..resizing layer '{k}':{pos} labelled '{layer.name}'")
+                w0, h0 = extent(layer)
                 if x is not None:
                     w = x
                 else:
-                    w = img.shape[1]
+                    w = w0
                 if y is not None:
                     h = y
                 else:
-                    h = img.shape[0]
-                img0 = np.zeros((h,w)+img.shape[2:],dtype=np.uint8)
-                x1 = min(w,img.shape[1])
-                y1 = min(h,img.shape[0])
+                    h = h0
                 if mode == "crop":
-                    img0[0:y1,0:x1] = img[0:y1,0:x1]
-                elif mode == "interpolation":
+                    add_transform(layer, np.identity(3), (w,h))
+                elif not anti_aliasing:
+                    # cval is given for channel values in 0..1
+                    add_transform(layer, scale_transform((w0,h0), (w,h)), (w,h),
+                                  (int(order), interpolation_mode, float(cval)*255, as_boolean(clip)))
+                else:
+                    img = canvas_pixels(layer)
                     img0 = (sit.resize(img / 255., (h,w)+img.shape[2:], 
                                         order=order, 
                                         mode=interpolation_mode,
@@ -1087,43 +3028,462 @@ def work(task):
                                         clip=clip,
                                         anti_aliasing=anti_aliasing,
                                         anti_aliasing_sigma=anti_aliasing_sigma)*255).astype(np.uint8)
-                else:
-                    print(f"!!WARNING!! resize mode {mode} is unknown, using 'crop'.")
-                    img0[0:y1,0:x1] = img[0:y1,0:x1]
-                data[k][idx] = (name, img0)
+                    layer.set_pixels(img0)
         elif op == 'fix-transparent-color':
             thr = int(params["threshold"])
             full_neighborhood = str(params["neighborhood"]).strip()=="8"
-            for k,idx in get_image_layers(data,params["images"],params["layers"]):
-                lbl,img = data[k][idx]
-                print(f"    ..applying to layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                img = fix_transparent_color(img,thr,full_neighborhood)
-                data[k][idx] = (lbl, img)
+            iterations = max(int(params["iterations"]),1)
+            for k,key,pos in decode_image_layers(data,params["images"],params["layers"],workers,discard):
+                layer = data[k][key]
+                print(f"    ..applying to layer '{k}':{pos} labelled '{layer.name}'")
+                # only transparent pixels next to the layer may change
+                pixels, x, y = padded_pixels(layer, iterations)
+                layer.set_pixels(fix_transparent_color(pixels,thr,full_neighborhood,iterations), x, y, extent(layer))
         elif op == 'add-tileset-spaces':
             width = int(params["tile-width"])
             height = int(params["tile-height"])
             border = max(int(params["border-width"]),0)
             space = max(int(params["spacing-width"]),0)
-            for k,idx in get_image_layers(data,params["images"],params["layers"]):
-                lbl,img = data[k][idx]
-                print(f"    ..applying to layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                img = add_tileset_spacing(width,height,border,space, img)
-                data[k][idx] = (lbl, img)
+            for k,key,pos in decode_image_layers(data,params["images"],params["layers"],workers,discard):
+                layer = data[k][key]
+                print(f"    ..applying to layer '{k}':{pos} labelled '{layer.name}'")
+                layer.set_pixels(add_tileset_spacing(width,height,border,space, canvas_pixels(layer)))
         elif op == 'rm-tileset-spaces':
             width = int(params["tile-width"])
             height = int(params["tile-height"])
             border = max(int(params["border-width"]),0)
             space = max(int(params["spacing-width"]),0)
-            for k,idx in get_image_layers(data,params["images"],params["layers"]):
-                lbl,img = data[k][idx]
-                print(f"    ..applying to layer '{k}':{len(data[k])-idx-1} labelled '{data[k][idx][0]}'")
-                img = rm_tileset_spacing(width,height,border,space, img)
-                data[k][idx] = (lbl, img)
+            for k,key,pos in decode_image_layers(data,params["images"],params["layers"],workers,discard):
+                layer = data[k][key]
+                print(f"    ..applying to layer '{k}':{pos} labelled '{layer.name}'")
+                layer.set_pixels(rm_tileset_spacing(width,height,border,space, canvas_pixels(layer)))
 
 
     for k in o:
         print(f"STORE: image '{k}' to '{o[k]}'.")
-        write_ora(o[k],data[k])
+        loads = keep.get(normal_path(o[k]), 0)
+        if loads > 0:
+            hand_over(o[k],data[k],get_option(task, "layer-format"),workers,loads)
+        else:
+            write_ora(o[k],data[k],get_option(task, "layer-format"),workers)
+    close_ora_files()
+
+def benchmark_palette_index():
+    """
+        compares the brute force and the k-d tree nearest palette color
+        search for growing palette sizes
+    """
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, (100000, 3)).astype(np.uint8)
+    print(f"nearest palette color of {len(colors)} random pixels:")
+    print("  palette size   brute force   k-d tree")
+    for size in [8, 16, 32, 48, 64, 96, 128, 256, 1024, 4096]:
+        palette = rng.integers(0, 256, (size, 3)).astype(np.float64)
+        t0 = time.perf_counter()
+        brute = nearest_palette_indices(colors, palette, use_tree=False)
+        t1 = time.perf_counter()
+        tree = nearest_palette_indices(colors, palette, use_tree=True)
+        t2 = time.perf_counter()
+        if not (brute == tree).all():
+            print("!!WARNING!! k-d tree search differs from brute force search!")
+        print(f"  {size:12d}   {(t1-t0)*1000:9.1f}ms  {(t2-t1)*1000:7.1f}ms" +
+              ("  <- k-d tree is used" if size >= kdtree_palette_size else ""))
+
+# bump this whenever the way tasks are hashed changes, so that all tasks are
+# run again
+manifest_version = 2
+
+def load_manifest(path):
+    """
+        returns the build manifest stored at path, or an empty one
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if type(manifest) == dict and manifest.get("version") == manifest_version:
+            return manifest
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"WARNING: ignoring broken manifest '{path}': {e}")
+    return {"version": manifest_version, "files": {}, "tasks": {}}
+
+def save_manifest(path, manifest):
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"WARNING: could not store manifest '{path}': {e}")
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+def file_digest(path, manifest):
+    """
+        returns the sha1 hex digest of the contents of the file at path, or
+        None if there is no such file; the digest is recorded in the manifest
+        and reused while size and modification time of the file stay the same
+    """
+    path = normal_path(path)
+    wait_for_writes([path])
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    known = manifest["files"].get(path)
+    if known is not None and known[:2] == [st.st_size, st.st_mtime_ns]:
+        return known[2]
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    manifest["files"][path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+def task_outputs(task):
+    o = transform_input_output_to_dict(task["output"])
+    return sorted(normal_path(o[k]) for k in o)
+
+def task_inputs(task):
+    i = transform_input_output_to_dict(task["input"])
+    return sorted(normal_path(i[k]) for k in i)
+
+def task_keys(tasks):
+    """
+        returns the keys of the tasks in the manifest: their output paths,
+        and how many tasks before write the same paths, so that tasks that
+        rewrite a file in place are told apart
+    """
+    seen = {}
+    keys = []
+    for task in tasks:
+        outputs = repr(task_outputs(task))
+        seen[outputs] = seen.get(outputs, 0) + 1
+        keys.append(f"{outputs}#{seen[outputs]}")
+    return keys
+
+def task_hash(task, manifest, expected={}):
+    """
+        returns (hash, digests) of everything the outputs of the task depend
+        on: its ops with their default parameters filled in, the contents of
+        its input and palette files, its options and this tool itself; and
+        the digests of those files by path.
 
-for task in todo:
-    work(task)
+        Files that are expected to hold what an earlier task has written are
+        taken by their digest in expected instead of their contents.
+    """
+    i = transform_input_output_to_dict(task["input"])
+    o = transform_input_output_to_dict(task["output"])
+    ops = transform_ops(task["ops"])
+    digests = {}
+    def digest(path):
+        path = normal_path(path)
+        if not path in digests:
+            digests[path] = expected[path] if path in expected else file_digest(path, manifest)
+        return digests[path]
+    palettes = []
+    for op, params in ops:
+        palette = params.get("palette")
+        if type(palette) == str and not palette in named_palettes:
+            palettes.append(digest(find_palette_file(palette, get_option(task, "palette-path")) or palette))
+    h = hashlib.sha1(repr((manifest_version, digest(__file__),
+                           sorted((k, str(i[k]), digest(i[k])) for k in i),
+                           sorted((k, str(o[k])) for k in o),
+                           [(op, sorted(params.items())) for op, params in ops], palettes,
+                           get_option(task, "layer-format"))).encode("utf-8"))
+    return h.hexdigest(), digests
+
+def rewrite_groups(tasks):
+    """
+        returns for each task the tuple of tasks that are only skipped all
+        together, or None: the tasks that write a file which is written more
+        than once, and those that read it before it is written the last time.
+        The files only hold what the last of them have written, so a task of
+        the group can not be run on what the tasks before have written.
+    """
+    writers = {}
+    for n, task in enumerate(tasks):
+        for path in task_outputs(task):
+            writers.setdefault(path, []).append(n)
+    group = list(range(len(tasks)))
+    def find(n):
+        while group[n] != n:
+            group[n] = group[group[n]]
+            n = group[n]
+        return n
+    for n, task in enumerate(tasks):
+        for path in task_inputs(task) + task_outputs(task):
+            w = writers.get(path, [])
+            if len(w) > 1 and n < w[-1] or n in w[1:]:
+                group[find(n)] = find(w[0])
+    members = {}
+    for n in range(len(tasks)):
+        members.setdefault(find(n), []).append(n)
+    return [tuple(members[find(n)]) if len(members[find(n)]) > 1 else None for n in range(len(tasks))]
+
+def is_up_to_date(task, key, digest, manifest):
+    """
+        whether the task has been run with the same hash before, and its
+        output files are still the ones it has written
+    """
+    known = manifest["tasks"].get(key)
+    if known is None or known["hash"] != digest:
+        return False
+    return all(file_digest(path, manifest) == known["outputs"].get(path) for path in task_outputs(task))
+
+def record_task(task, key, digest, digests, manifest):
+    outputs = task_outputs(task)
+    manifest["tasks"][key] = {"hash": digest, "inputs": digests,
+                              "outputs": {path: file_digest(path, manifest) for path in outputs}}
+
+def prune_manifest(manifest):
+    """ forgets the digests of files that no recorded task refers to """
+    used = set()
+    for known in manifest["tasks"].values():
+        used.update(known["inputs"])
+        used.update(known["outputs"])
+    for path in [path for path in manifest["files"] if not path in used]:
+        del manifest["files"][path]
+
+def task_dependencies(tasks):
+    """
+        returns for each task the set of earlier tasks it has to wait for:
+        those that write files it reads or writes, and those that read files
+        it writes; and for each task the later tasks that read each file it
+        writes, before it is written again
+    """
+    writer = {}
+    readers = {}
+    deps = []
+    consumers = []
+    for n, task in enumerate(tasks):
+        d = set()
+        for path in task_inputs(task):
+            if path in writer:
+                d.add(writer[path])
+                consumers[writer[path]].setdefault(path, []).append(n)
+        for path in task_outputs(task):
+            if path in writer:
+                d.add(writer[path])
+            d.update(readers.get(path, []))
+        for path in task_inputs(task):
+            readers.setdefault(path, []).append(n)
+        for path in task_outputs(task):
+            writer[path] = n
+            readers[path] = []
+        d.discard(n)
+        deps.append(d)
+        consumers.append({})
+    return deps, consumers
+
+def run_task(task, keep={}, capture=False):
+    """
+        runs the task and returns (log, error), where error is the traceback
+        of the exception that stopped the task or None; the log holds what
+        the task has printed if capture is set
+    """
+    out = io.StringIO() if capture else None
+    error = None
+    with contextlib.redirect_stdout(out) if capture else contextlib.nullcontext():
+        try:
+            work(task, keep)
+        except Exception:
+            error = traceback.format_exc()
+            close_ora_files()
+    return (out.getvalue() if capture else "", error)
+
+def run_job(job, job_options):
+    """
+        runs the (task, keep) pairs of a chain of tasks in a worker process
+        with the given options one after another, until one of them fails,
+        and returns the (log, error) of each task that has run; the files
+        that are written in the background are done by then
+    """
+    options.update(job_options)
+    results = []
+    for task, keep in job:
+        results.append(run_task(task, keep, True))
+        if results[-1][1] is not None:
+            break
+    wait_for_writes()
+    handed_images.clear()
+    for path, e in write_errors:
+        for n, (task, _) in enumerate(job[:len(results)]):
+            if path in task_outputs(task):
+                log, error = results[n]
+                results[n] = (log, (error or "") + f"could not write '{path}': {e}\n")
+    write_errors.clear()
+    return results
+
+def process_pool(jobs):
+    """
+        returns a pool of jobs processes; they are forked where possible, so
+        they start with the options and palettes of this process
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork"))
+    return ProcessPoolExecutor(max_workers=jobs)
+
+def run_tasks(tasks, jobs=1, manifest=None):
+    """
+        runs the tasks in the order of their dependencies, up to jobs of them
+        at a time, and returns the number of failed tasks. Tasks that depend
+        on a failed task are not run; tasks that are up to date according to
+        the manifest are skipped.
+
+        Images that a task stores for later tasks are handed over to them in
+        memory, if they run in the same process: all of them when the tasks
+        are run one at a time, otherwise the tasks of a chain, where each
+        task only depends on the one before, which runs as a single job.
+    """
+    deps, consumers = task_dependencies(tasks)
+    keys = task_keys(tasks)
+    groups = rewrite_groups(tasks)
+    # digests of the files as the tasks that have been run or skipped have
+    # written them, and whether the tasks of a group are up to date
+    expected = {}
+    up_to_date = {}
+    finished = set()
+    waiting = [set(d) for d in deps]
+    dependents = [[] for _ in tasks]
+    for n, d in enumerate(deps):
+        for m in d:
+            dependents[m].append(n)
+    ready = [n for n in range(len(tasks)) if not waiting[n]]
+    heapq.heapify(ready)
+    failed = set()
+    chained = set()
+    running = {}
+    jobs = min(worker_count(jobs), len(tasks))
+    pool = process_pool(jobs) if jobs > 1 else None
+    # the cpu cores are shared by the threads of all worker processes
+    job_options = dict(options)
+    job_options["workers"] = min(worker_count(options["workers"]), max(1, (os.cpu_count() or 1) // jobs))
+
+    def finish(n, log, error, ran=True):
+        print(log, end="")
+        finished.add(n)
+        if error is not None:
+            print(f"ERROR: task writing {transform_input_output_to_dict(tasks[n]['output'])} failed:\n{error}")
+            failed.add(n)
+        elif ran and manifest is not None and not as_boolean(get_option(tasks[n], "explain")):
+            record_task(tasks[n], keys[n], *task_hash(tasks[n], manifest, expected), manifest)
+            expected.update(manifest["tasks"][keys[n]]["outputs"])
+        for m in dependents[n]:
+            waiting[m].discard(n)
+            if not waiting[m] and not m in chained:
+                heapq.heappush(ready, m)
+
+    def skip(n, reason):
+        # the images handed over to the task are not loaded
+        for path in task_inputs(tasks[n]):
+            release_handed(path)
+        finish(n, f"SKIP: {transform_input_output_to_dict(tasks[n]['output'])}{reason}\n", None, False)
+
+    def is_skipped(n):
+        """ whether the task is up to date, together with its group """
+        if groups[n] is None:
+            return is_up_to_date(tasks[n], keys[n], task_hash(tasks[n], manifest, expected)[0], manifest)
+        if not groups[n] in up_to_date:
+            up_to_date[groups[n]] = group_up_to_date(groups[n])
+        return up_to_date[groups[n]]
+
+    def group_up_to_date(group):
+        expect = dict(expected)
+        for m in group:
+            if any(not d in group and not d in finished for d in deps[m]):
+                return False
+            known = manifest["tasks"].get(keys[m])
+            if known is None or known["hash"] != task_hash(tasks[m], manifest, expect)[0]:
+                return False
+            expect.update(known["outputs"])
+        # the files hold what the last tasks of the group have written
+        return all(file_digest(path, manifest) == expect.get(path)
+                   for m in group for path in task_outputs(tasks[m]))
+
+    def chain(n):
+        job = [n]
+        # the tasks after the first one are run without checking whether
+        # they are up to date: they read a file that the task before has
+        # just written, which hardly ever has the digest recorded for it,
+        # since zip entries carry the time they are written. Tasks that are
+        # only skipped together with others are not chained.
+        while len(dependents[job[-1]]) == 1:
+            m = dependents[job[-1]][0]
+            if deps[m] != {job[-1]} or not any(m in readers for readers in consumers[job[-1]].values()):
+                break
+            if manifest is not None and groups[m] is not None:
+                break
+            job.append(m)
+        return job
+
+    def keep(n, job=None):
+        loads = {}
+        for path, readers in consumers[n].items():
+            count = len([m for m in readers if job is None or m in job])
+            if count > 0:
+                loads[path] = count
+        return loads
+
+    try:
+        while ready or running:
+            while ready:
+                n = heapq.heappop(ready)
+                task = tasks[n]
+                if deps[n] & failed:
+                    skip(n, ", since a task it depends on failed.")
+                    failed.add(n)
+                    continue
+                if manifest is not None and not as_boolean(get_option(task, "explain")):
+                    if is_skipped(n):
+                        expected.update(manifest["tasks"][keys[n]]["outputs"])
+                        skip(n, " is up to date.")
+                        continue
+                if pool is None:
+                    finish(n, *run_task(task, keep(n)))
+                else:
+                    job = chain(n)
+                    chained.update(job[1:])
+                    running[pool.submit(run_job, [(tasks[m], keep(m, job)) for m in job], job_options)] = job
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=lambda f: running[f][0]):
+                    job = running.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception:
+                        results = [("", traceback.format_exc())]
+                    for n, (log, error) in zip(job, results):
+                        finish(n, log, error)
+                    chained.difference_update(job[1:])
+                    # the tasks of the chain after a failed one are skipped
+                    for m in job[len(results):]:
+                        if not waiting[m]:
+                            heapq.heappush(ready, m)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        wait_for_writes()
+        handed_images.clear()
+    for path, e in write_errors:
+        print(f"ERROR: could not write '{path}': {e}")
+    return len(failed) + len(write_errors)
+
+if __name__ == "__main__":
+    if sys.argv[1] == "benchmark":
+        for b in benchmarks:
+            print(f"BENCHMARK: {b}")
+            {"palette-index": benchmark_palette_index}[b]()
+
+    manifest = load_manifest(options["manifest"]) if options["manifest"] else None
+    try:
+        failures = run_tasks(todo, options["jobs"], manifest)
+    finally:
+        if manifest is not None:
+            prune_manifest(manifest)
+            save_manifest(options["manifest"], manifest)
+    if failures:
+        print(f"ERROR: {failures} of {len(todo)} tasks could not be completed.")
+        sys.exit(1)
@@ -0,0 +1,773 @@
+import io
+import os
+import subprocess
+import sys
+import zipfile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+TOOL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "ora-tool.py")
+
+
+def png(array):
+    buf = io.BytesIO()
+    Image.fromarray(array).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def write_ora(path, layers, w, h):
+    """ layers are (name, RGBA array, x, y[, {attribute: value}]) from top to bottom """
+    stack = f'<image w="{w}" h="{h}">\n  <stack>\n'
+    for n, (name, _, x, y, *attributes) in enumerate(layers):
+        extra = "".join(f' {k}="{v}"' for attrs in attributes for k, v in attrs.items())
+        stack += f'    <layer name="{name}" x="{x}" y="{y}"{extra} src="data/layer{n}.png" />\n'
+    stack += "  </stack>\n</image>"
+    with zipfile.ZipFile(path, "w") as f:
+        f.writestr("mimetype", "image/openraster")
+        f.writestr("stack.xml", stack)
+        for n, (_, array, *_) in enumerate(layers):
+            f.writestr(f"data/layer{n}.png", png(array))
+
+
+def read_ora(path):
+    """ returns {name: (RGBA array, x, y)} of the layers of the file """
+    import xmltodict
+    with zipfile.ZipFile(path) as f:
+        stack = xmltodict.parse(f.read("stack.xml"))["image"]["stack"]["layer"]
+        stack = stack if isinstance(stack, list) else [stack]
+        layers = {}
+        for x in stack:
+            img = Image.open(io.BytesIO(f.read(x["@src"]))).convert("RGBA")
+            layers[x["@name"]] = (np.asarray(img), int(x.get("@x", 0)), int(x.get("@y", 0)))
+        return layers
+
+
+def run_yaml(tmp_path, text, *args, returncode=0):
+    path = tmp_path / "tasks.yaml"
+    path.write_text(text, encoding="utf-8")
+    result = subprocess.run([sys.executable, TOOL, "yaml", str(path)] + list(args),
+                            capture_output=True, text=True, cwd=tmp_path)
+    assert result.returncode == returncode, result.stdout + result.stderr
+    return result.stdout
+
+
+@pytest.fixture(scope="module")
+def tool():
+    """ the functions of ora-tool.py, which is imported with an empty yaml task list """
+    import importlib.util
+    argv = sys.argv
+    sys.argv = [TOOL, "yaml", os.devnull]
+    try:
+        spec = importlib.util.spec_from_file_location("ora_tool", TOOL)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = argv
+    return module
+
+
+def random_layer(seed, h, w):
+    rng = np.random.default_rng(seed)
+    array = rng.integers(0, 256, (h, w, 4), dtype=np.uint8)
+    array[..., 3] = np.where(array[..., 3] < 128, 0, 255)
+    return array
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_yaml_chained_tasks(tmp_path, jobs):
+    write_ora(tmp_path / "in.ora", [("top", random_layer(0, 16, 16), 0, 0),
+                                    ("bottom", random_layer(1, 16, 16), 0, 0)], 16, 16)
+    tasks = f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "a.ora"}
+    ops: [{{to-binary-alpha: {{threshold: 128, t0: 0, t1: 200}}}}]
+- ora-tool:
+    input: {tmp_path / "a.ora"}
+    output: {tmp_path / "b.ora"}
+    ops: [{{rm-layers: {{layers: bottom}}}}]
+"""
+    manifest = str(tmp_path / "manifest.json")
+    out = run_yaml(tmp_path, tasks, "--jobs", jobs, "--manifest", manifest)
+    assert "SKIP" not in out
+    a = read_ora(tmp_path / "a.ora")
+    b = read_ora(tmp_path / "b.ora")
+    assert sorted(a) == ["bottom", "top"]
+    assert sorted(b) == ["top"]
+    assert set(np.unique(b["top"][0][..., 3])) <= {0, 200}
+    assert np.array_equal(a["top"][0], b["top"][0])
+    out = run_yaml(tmp_path, tasks, "--jobs", jobs, "--manifest", manifest)
+    assert out.count("SKIP") == 2
+
+
+def test_manifest_in_place_chain(tmp_path):
+    import json
+    write_ora(tmp_path / "in.ora", [("top", random_layer(2, 8, 8), 0, 0),
+                                    ("bottom", random_layer(3, 8, 8), 0, 0)], 8, 8)
+    x = tmp_path / "x.ora"
+    tasks = f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {x}
+    ops: [to-binary-alpha]
+- ora-tool:
+    input: {x}
+    output: {x}
+    ops: [{{rm-layers: {{layers: bottom}}}}]
+"""
+    manifest = tmp_path / "manifest.json"
+    run_yaml(tmp_path, tasks, "--manifest", str(manifest))
+    assert sorted(read_ora(x)) == ["top"]
+    assert run_yaml(tmp_path, tasks, "--manifest", str(manifest)).count("SKIP") == 2
+    # files that no task refers to any more are forgotten
+    (tmp_path / "in2.ora").write_bytes((tmp_path / "in.ora").read_bytes())
+    run_yaml(tmp_path, tasks.replace("in.ora", "in2.ora"), "--manifest", str(manifest))
+    files = json.loads(manifest.read_text())["files"]
+    assert str(tmp_path / "in2.ora") in files
+    assert str(tmp_path / "in.ora") not in files
+    # a changed task of an in place chain runs the whole chain again
+    out = run_yaml(tmp_path, tasks.replace("in.ora", "in2.ora").replace("layers: bottom", "layers: top"),
+                   "--manifest", str(manifest))
+    assert "SKIP" not in out
+    assert sorted(read_ora(x)) == ["bottom"]
+
+
+def test_rotate_quarter_turn(tmp_path):
+    layer = random_layer(4, 12, 12)
+    layer[..., 3] = 255
+    write_ora(tmp_path / "in.ora", [("l", layer, 0, 0)], 12, 12)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "out.ora"}
+    ops: [{{rotate-layers: {{angle: 90, resize: true, center: "6,6"}}}}]
+""")
+    array, x, y = read_ora(tmp_path / "out.ora")["l"]
+    assert (x, y) == (0, 0)
+    assert np.array_equal(array, np.rot90(layer))
+
+
+def test_negative_layer_offset(tmp_path):
+    layer = random_layer(5, 16, 20)
+    layer[..., 3] = 255
+    layer[4:8, 8:12, 3] = 0
+    write_ora(tmp_path / "in.ora", [("l", layer, -5, -2)], 16, 16)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "a.ora"}
+    ops: [fix-transparent-color]
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "b.ora"}
+    ops: [{{add-tileset-spaces: {{layers: l, tile-width: 4, tile-height: 4, border-width: 0, spacing-width: 1}}}}]
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "c.ora"}
+    ops: [{{rotate-layers: {{angle: 30}}}}]
+""")
+    array, x, y = read_ora(tmp_path / "a.ora")["l"]
+    assert (x, y) == (0, 0)
+    # the part left of and above the canvas is cut off
+    assert np.array_equal(array[:14, :15, 3], layer[2:, 5:, 3])
+    assert np.array_equal(array[:2, :15], layer[2:4, 5:])
+    array, x, y = read_ora(tmp_path / "b.ora")["l"]
+    assert np.array_equal(array[:4, :4], layer[2:6, 5:9])
+    assert read_ora(tmp_path / "c.ora")["l"][0].shape[2] == 4
+
+
+def test_rewrite_after_hand_over(tmp_path):
+    write_ora(tmp_path / "in.ora", [("top", random_layer(6, 8, 8), 0, 0),
+                                    ("bottom", random_layer(7, 8, 8), 0, 0)], 8, 8)
+    x = tmp_path / "x.ora"
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {x}
+    ops: [to-binary-alpha]
+- ora-tool:
+    input: {x}
+    output: {x}
+    ops: [{{rm-layers: {{layers: bottom}}}}]
+""")
+    assert sorted(read_ora(x)) == ["top"]
+    assert sorted(os.listdir(tmp_path)) == ["in.ora", "tasks.yaml", "x.ora"]
+
+
+def test_merge_cropped_layers(tmp_path):
+    top = random_layer(8, 16, 16)
+    top[..., 3] = 128
+    bottom = np.zeros((16, 16, 4), dtype=np.uint8)
+    bottom[5:9, 6:12] = random_layer(9, 4, 6)
+    extra = random_layer(10, 16, 16)
+    write_ora(tmp_path / "full.ora", [("top", top, 0, 0), ("bottom", bottom, 0, 0),
+                                      ("extra", extra, 0, 0)], 16, 16)
+    write_ora(tmp_path / "cropped.ora", [("top", top, 0, 0), ("bottom", bottom[5:9, 6:12], 6, 5),
+                                         ("extra", extra, 0, 0)], 16, 16)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "full.ora"}
+    output: {tmp_path / "a.ora"}
+    ops: [{{rm-layers: {{layers: extra}}}}]
+- ora-tool:
+    input: {tmp_path / "cropped.ora"}
+    output: {tmp_path / "b.ora"}
+    ops: [{{rm-layers: {{layers: extra}}}}]
+""")
+    merged = []
+    for name in ["a.ora", "b.ora"]:
+        with zipfile.ZipFile(tmp_path / name) as f:
+            merged.append(np.asarray(Image.open(io.BytesIO(f.read("mergedimage.png"))).convert("RGBA")))
+    assert np.array_equal(merged[0], merged[1])
+    # transparent pixels below a layer leave its color as it is
+    assert np.array_equal(merged[0][0, 0], top[0, 0])
+
+
+def test_move_out_and_back(tmp_path):
+    layer = random_layer(11, 16, 16)
+    layer[..., 3] = 255
+    write_ora(tmp_path / "in.ora", [("l", layer, 0, 0)], 16, 16)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "a.ora"}
+    ops: [{{move-layers: {{x: -5}}}}, {{move-layers: {{x: 5}}}}]
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "b.ora"}
+    ops: [{{move-layers: {{x: -5}}}}]
+- ora-tool:
+    input: {tmp_path / "b.ora"}
+    output: {tmp_path / "c.ora"}
+    ops: [{{move-layers: {{x: 5}}}}]
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "d.ora"}
+    ops: [{{move-layers: {{y: -3}}}}, flip-layers, {{move-layers: {{y: 3}}}}, {{flip-layers: {{axis: vertical}}}}]
+""")
+    a = read_ora(tmp_path / "a.ora")["l"]
+    c = read_ora(tmp_path / "c.ora")["l"]
+    # the columns that are moved beyond the left border are cut off
+    assert a[1:] == (5, 0) and c[1:] == (5, 0)
+    assert np.array_equal(a[0], layer[:, 5:])
+    assert np.array_equal(c[0], layer[:, 5:])
+    array, x, y = read_ora(tmp_path / "d.ora")["l"]
+    assert (x, y) == (0, 0)
+    assert np.array_equal(array, layer[3:, ::-1][::-1])
+
+
+def test_hand_over_copies_unchanged_layers(tmp_path):
+    write_ora(tmp_path / "in.ora", [("top", random_layer(12, 8, 8), 0, 0),
+                                    ("bottom", random_layer(13, 8, 8), 0, 0)], 8, 8)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "a.ora"}
+    ops: [{{move-layers: {{x: 2, y: 1}}}}]
+- ora-tool:
+    input: {tmp_path / "a.ora"}
+    output: {tmp_path / "b.ora"}
+    ops: [{{rm-layers: {{layers: bottom}}}}]
+- ora-tool:
+    input: {tmp_path / "a.ora"}
+    output: {tmp_path / "c.ora"}
+    ops: [{{rm-layers: {{layers: nothing}}}}]
+""")
+    a = zipfile.ZipFile(tmp_path / "a.ora")
+    b = zipfile.ZipFile(tmp_path / "b.ora")
+    c = zipfile.ZipFile(tmp_path / "c.ora")
+    assert read_ora(tmp_path / "b.ora")["top"][1:] == (2, 1)
+    assert b.read("data/layer0.png") == a.read("data/layer1.png")
+    # the merged image of an unchanged layer stack is copied as well
+    assert c.read("mergedimage.png") == a.read("mergedimage.png")
+    assert c.read("data/layer0.png") == a.read("data/layer0.png")
+
+
+def test_kdtree_palette_search(tool, monkeypatch):
+    rng = np.random.default_rng(14)
+    # a grid palette with duplicates: pixels halfway between grid colors and
+    # on duplicated colors have several nearest palette colors
+    grid = np.stack(np.meshgrid(*[np.arange(0, 256, 51)] * 3), axis=-1).reshape((-1, 3))
+    palette = np.concatenate([grid, grid[::7]]).astype(np.float64)
+    colors = np.concatenate([rng.integers(0, 256, (3000, 3)),
+                             grid + rng.choice([0, 25.5], grid.shape),
+                             grid]).astype(np.float64)
+    chunk_elements = 4096
+    distances = tool.palette_distances
+
+    def bounded_distances(x, dist_palette, divisor, candidates=None):
+        n = dist_palette.shape[0] if candidates is None else candidates.shape[1]
+        assert x.shape[0] * n <= chunk_elements
+        return distances(x, dist_palette, divisor, candidates)
+    monkeypatch.setattr(tool, "palette_distances", bounded_distances)
+    brute = tool.nearest_palette_indices(colors, palette, chunk_elements=chunk_elements, use_tree=False)
+    tree = tool.nearest_palette_indices(colors, palette, chunk_elements=chunk_elements, use_tree=True)
+    assert np.array_equal(brute, tree)
+    # ties are resolved in favor of the lower palette index
+    assert np.array_equal(brute[-len(grid):], np.arange(len(grid)))
+
+
+@pytest.mark.parametrize("angle", [90, 180, 270, -90])
+def test_rotate_quarter_turns_copy_pixels(tmp_path, angle):
+    layer = random_layer(15, 10, 14)
+    layer[..., 3] = 255
+    write_ora(tmp_path / "in.ora", [("l", layer, 0, 0)], 14, 10)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "out.ora"}
+    ops: [{{rotate-layers: {{angle: {angle}, resize: true}}}}]
+""")
+    array, x, y = read_ora(tmp_path / "out.ora")["l"]
+    assert (x, y) == (0, 0)
+    # the pixels are taken as they are, not resampled with rounding errors
+    assert np.array_equal(array, np.rot90(layer, angle // 90))
+
+
+@pytest.mark.parametrize("w, h, order, expected", [
+    (36, 24, 0, lambda l: l.repeat(2, axis=0).repeat(2, axis=1)),
+    (54, 12, 0, lambda l: l.repeat(3, axis=1)),
+    (9, 6, 1, lambda l: (l.astype(int).reshape((6, 2, 9, 2, 4)).sum(axis=(1, 3)) // 4).astype(np.uint8)),
+    (6, 4, 1, lambda l: l[1::3, 1::3]),
+])
+def test_resize_integer_factors_copy_pixels(tmp_path, w, h, order, expected):
+    layer = random_layer(16, 12, 18)
+    layer[..., 3] = 255
+    write_ora(tmp_path / "in.ora", [("l", layer, 0, 0)], 18, 12)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "out.ora"}
+    ops: [{{resize-layers: {{w: {w}, h: {h}, mode: interpolation, order: {order}}}}}]
+""")
+    array, x, y = read_ora(tmp_path / "out.ora")["l"]
+    assert (x, y) == (0, 0)
+    # enlarging repeats the pixels, shrinking takes the center pixel of odd
+    # blocks or the mean of 2x2 pixels rounded down
+    assert np.array_equal(array, expected(layer))
+
+
+def test_resave_keeps_merged_image(tmp_path):
+    write_ora(tmp_path / "in.ora", [("top", random_layer(17, 16, 16), 0, 0),
+                                    ("bottom", random_layer(18, 16, 16), 0, 0),
+                                    ("extra", random_layer(19, 16, 16), 0, 0)], 16, 16)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "a.ora"}
+    ops: [{{rm-layers: {{layers: extra}}}}]
+- ora-tool:
+    input: {tmp_path / "a.ora"}
+    output: {tmp_path / "b.ora"}
+    ops: []
+- ora-tool:
+    input:
+      a: {tmp_path / "a.ora"}
+    output:
+      copy: {tmp_path / "c.ora"}
+    ops: [{{cp-layers: {{images: a, layers: "+.*", target: copy}}}}]
+""")
+    a = zipfile.ZipFile(tmp_path / "a.ora")
+    for name in ["b.ora", "c.ora"]:
+        f = zipfile.ZipFile(tmp_path / name)
+        for entry in ["mergedimage.png", "Thumbnails/thumbnail.png", "data/layer0.png", "data/layer1.png"]:
+            assert f.read(entry) == a.read(entry)
+
+
+def layer_stack(path, tool):
+    """ returns the layers of the file as Layer objects from top to bottom, and the canvas size """
+    import xmltodict
+    with zipfile.ZipFile(path) as f:
+        image = xmltodict.parse(f.read("stack.xml"))["image"]
+    size = (int(image["@w"]), int(image["@h"]))
+    return [tool.Layer(name, array, x, y, size=size) for name, (array, x, y) in read_ora(path).items()], size
+
+
+def test_partial_composite_update(tmp_path, tool, monkeypatch):
+    small = np.zeros((4, 4, 4), dtype=np.uint8)
+    small[..., 0] = 255
+    small[..., 3] = 128
+    top = random_layer(20, 24, 24)
+    top[..., 3] //= 2
+    write_ora(tmp_path / "in.ora", [("top", top, 0, 0), ("small", small, 3, 3),
+                                    ("gone", small, 15, 15), ("bottom", random_layer(21, 24, 24), 0, 0)], 24, 24)
+    tool.run_tasks([{"input": str(tmp_path / "in.ora"), "output": str(tmp_path / "a.ora"), "ops": []}])
+
+    def full_merge(*args):
+        raise AssertionError("the whole stack is merged again")
+    monkeypatch.setattr(tool, "merge_layers_cached", full_merge)
+    tool.run_tasks([{"input": str(tmp_path / "a.ora"), "output": str(tmp_path / "b.ora"),
+                     "ops": [{"move-layers": {"layers": "small", "x": 2}}, {"rm-layers": {"layers": "gone"}}]}])
+    layers, (w, h) = layer_stack(tmp_path / "b.ora", tool)
+    assert [layer.name for layer in layers] == ["top", "small", "bottom"]
+    with zipfile.ZipFile(tmp_path / "b.ora") as f:
+        merged = np.asarray(Image.open(io.BytesIO(f.read("mergedimage.png"))).convert("RGBA"))
+    assert np.array_equal(merged, tool.merge_layers(layers, (0, 0, w, h)))
+
+
+def test_top_composite_reuse(tmp_path, tool, monkeypatch):
+    write_ora(tmp_path / "in.ora", [("top", random_layer(22, 16, 16), 0, 0),
+                                    ("mid", random_layer(23, 16, 16), 0, 0),
+                                    ("bottom", random_layer(24, 16, 16), 0, 0)], 16, 16)
+    built = []
+    composite_layers = tool.composite_layers
+
+    def counted(layers, output=None):
+        built.append([layer.name for layer in layers])
+        return composite_layers(layers, output)
+    monkeypatch.setattr(tool, "composite_layers", counted)
+    for name in ["a.ora", "b.ora"]:
+        tool.run_tasks([{"input": str(tmp_path / "in.ora"), "output": str(tmp_path / name),
+                         "ops": [{"to-binary-alpha": {"layers": "bottom", "t1": 200}}]}])
+    # the unchanged top layers are blended once, the changed one each time
+    assert built == [["top", "mid"], ["bottom"], ["bottom"]]
+    layers, (w, h) = layer_stack(tmp_path / "b.ora", tool)
+    with zipfile.ZipFile(tmp_path / "b.ora") as f:
+        merged = np.asarray(Image.open(io.BytesIO(f.read("mergedimage.png"))).convert("RGBA"))
+    assert np.array_equal(merged, tool.merge_layers(layers, (0, 0, w, h)))
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_failed_task_skips_chain(tmp_path, jobs):
+    write_ora(tmp_path / "in.ora", [("l", random_layer(25, 8, 8), 0, 0)], 8, 8)
+    manifest = str(tmp_path / "manifest.json")
+    out = run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "a.ora"}
+    ops: [to-binary-alpha]
+- ora-tool:
+    input: {tmp_path / "a.ora"}
+    output: {tmp_path / "b.ora"}
+    ops: [{{resize-layers: {{w: wide}}}}]
+- ora-tool:
+    input: {tmp_path / "b.ora"}
+    output: {tmp_path / "c.ora"}
+    ops: [flip-layers]
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "d.ora"}
+    ops: [flip-layers]
+""", "--jobs", jobs, "--manifest", manifest, returncode=1)
+    assert "since a task it depends on failed" in out
+    assert "ERROR: 2 of 4 tasks could not be completed." in out
+    assert sorted(os.listdir(tmp_path)) == ["a.ora", "d.ora", "in.ora", "manifest.json", "tasks.yaml"]
+    # the tasks that have run are recorded, the others run again
+    out = run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "a.ora"}
+    ops: [to-binary-alpha]
+- ora-tool:
+    input: {tmp_path / "a.ora"}
+    output: {tmp_path / "b.ora"}
+    ops: [{{resize-layers: {{w: 4}}}}]
+- ora-tool:
+    input: {tmp_path / "b.ora"}
+    output: {tmp_path / "c.ora"}
+    ops: [flip-layers]
+""", "--jobs", jobs, "--manifest", manifest)
+    assert out.count("SKIP") == 1
+    assert read_ora(tmp_path / "c.ora")["l"][0].shape[1] == 4
+
+
+@pytest.mark.parametrize("channels", [3, 4])
+def test_nearest_palette_ties_like_pixel_loop(tool, channels):
+    rng = np.random.default_rng(16)
+    # colors next to a palette of even values and its duplicates are often
+    # equally far from several palette colors
+    palette = np.array([[0, 0, 0], [2, 0, 0], [0, 2, 0], [0, 0, 2], [2, 2, 2], [0, 0, 0], [2, 0, 0]])
+    img = rng.integers(0, 4, (20, 30, channels), dtype=np.uint8)
+    expected = img.copy()
+    for y in range(img.shape[0]):
+        for x in range(img.shape[1]):
+            distances = [np.sqrt(np.sum(((img[y, x, :3] - p) / 255)**2)) for p in palette]
+            expected[y, x, :3] = palette[distances.index(min(distances))]
+    for method in ["pixels", "unique"]:
+        assert np.array_equal(tool.to_nearest_palette(img, palette, method=method), expected)
+
+
+@pytest.mark.parametrize("colorspace", ["rgb", "hsv"])
+def test_memoized_palette_search(tool, monkeypatch, colorspace):
+    from collections import OrderedDict
+    monkeypatch.setattr(tool, "palette_memo", OrderedDict())
+    rng = np.random.default_rng(17)
+    colors = rng.integers(0, 256, (40, 4), dtype=np.uint8)
+    first = colors[rng.integers(0, 30, (50, 60))]
+    second = colors[rng.integers(10, 40, (50, 60))]
+    looked_up = []
+    search = tool.nearest_palette_indices
+
+    def counted(colors, *args, **kwargs):
+        looked_up.append(len(colors))
+        return search(colors, *args, **kwargs)
+    monkeypatch.setattr(tool, "nearest_palette_indices", counted)
+    for img in [first, second, first]:
+        memoized = tool.to_nearest_palette(img, tool.ega_palette, colorspace=colorspace, method="unique")
+        assert np.array_equal(memoized, tool.to_nearest_palette(img, tool.ega_palette, colorspace=colorspace,
+                                                                method="pixels"))
+    # the brute force searches count all pixels, the memoized ones only the
+    # colors that have not been looked up before
+    assert looked_up == [30, 50 * 60, 10, 50 * 60, 50 * 60]
+
+
+@pytest.mark.parametrize("bits", [8, 5])
+def test_palette_lookup_table(tool, monkeypatch, tmp_path, bits):
+    monkeypatch.setattr(tool, "palette_luts", {})
+    rng = np.random.default_rng(18)
+    img = rng.integers(0, 256, (40, 50, 4), dtype=np.uint8)
+    if bits < 8:
+        # coarser tables are exact for the colors in the centers of their cells
+        shift = 8 - bits
+        img[..., :3] = (img[..., :3] >> shift << shift) + (1 << shift >> 1)
+    expected = tool.to_nearest_palette(img, tool.ega_palette, method="pixels")
+    lut = tool.to_nearest_palette(img, tool.ega_palette, method="lut", lut_bits=bits, cache_dir=str(tmp_path))
+    assert np.array_equal(lut, expected)
+    # other processes load the compiled table from the cache directory
+    monkeypatch.setattr(tool, "palette_luts", {})
+    monkeypatch.setattr(tool, "compile_palette_lut", None)
+    cached = tool.to_nearest_palette(img, tool.ega_palette, method="lut", lut_bits=bits, cache_dir=str(tmp_path))
+    assert np.array_equal(cached, expected)
+    assert len(list((tmp_path / "palette-luts").glob("*.npy"))) == 1
+
+
+def test_indexed_layers_round_trip(tmp_path):
+    layer = random_layer(19, 20, 24)
+    layer[5:10, ..., 3] = 100
+    write_ora(tmp_path / "in.ora", [("l", layer, 0, 0)], 24, 20)
+    ops = "ops: [{to-nearest-palette: {palette: ega}}]"
+    tasks = f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "rgba.ora"}
+    {ops}
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "indexed.ora"}
+    layer-format: indexed
+    {ops}
+- ora-tool:
+    input: {tmp_path / "indexed.ora"}
+    output: {tmp_path / "again.ora"}
+    ops: [flip-layers]
+"""
+    run_yaml(tmp_path, tasks)
+    with zipfile.ZipFile(tmp_path / "indexed.ora") as f:
+        img = Image.open(io.BytesIO(f.read("data/layer0.png")))
+        # the 16 EGA colors with 3 alpha values fit in 8 bit palette indices
+        assert img.mode == "P"
+        assert "transparency" in img.info
+    expected = read_ora(tmp_path / "rgba.ora")["l"][0]
+    assert np.array_equal(read_ora(tmp_path / "indexed.ora")["l"][0], expected)
+    # indexed layers are decoded when they are changed
+    assert np.array_equal(read_ora(tmp_path / "again.ora")["l"][0], expected[:, ::-1])
+
+
+def layer_sources(path):
+    """ returns {name: zip entry} of the layers of the file """
+    import xmltodict
+    with zipfile.ZipFile(path) as f:
+        stack = xmltodict.parse(f.read("stack.xml"))["image"]["stack"]["layer"]
+    return {x["@name"]: x["@src"] for x in stack}
+
+
+def test_untouched_layers_stay_encoded(tmp_path, tool, monkeypatch):
+    write_ora(tmp_path / "in.ora", [("top", random_layer(25, 8, 8), 0, 0),
+                                    ("mid", random_layer(26, 8, 8), 8, 0),
+                                    ("bottom", random_layer(27, 8, 8), 16, 0)], 24, 8)
+    tool.run_tasks([{"input": str(tmp_path / "in.ora"), "output": str(tmp_path / "a.ora"), "ops": []}])
+    decoded = []
+    decode_source = tool.decode_source
+
+    def recorded(source):
+        decoded.append(source[1])
+        return decode_source(source)
+    monkeypatch.setattr(tool, "decode_source", recorded)
+    tool.run_tasks([{"input": str(tmp_path / "a.ora"), "output": str(tmp_path / "b.ora"),
+                     "ops": [{"to-binary-alpha": {"layers": "mid", "t1": 200}}]}])
+    # the layers next to the changed one are neither needed for its pixels
+    # nor for the merged image
+    assert decoded == [layer_sources(tmp_path / "a.ora")["mid"]]
+    b = read_ora(tmp_path / "b.ora")
+    assert set(np.unique(b["mid"][0][..., 3])) <= {0, 200}
+
+
+def test_unchanged_layers_keep_their_bytes(tmp_path):
+    write_ora(tmp_path / "in.ora", [("top", random_layer(28, 8, 8), 0, 0),
+                                    ("bottom", random_layer(29, 8, 8), 0, 0)], 8, 8)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "out.ora"}
+    ops: [{{to-binary-alpha: {{layers: top, t1: 200}}}}]
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "indexed.ora"}
+    layer-format: indexed
+    ops: []
+""")
+    source = layer_sources(tmp_path / "in.ora")
+    with zipfile.ZipFile(tmp_path / "in.ora") as f:
+        original = {name: f.read(entry) for name, entry in source.items()}
+    with zipfile.ZipFile(tmp_path / "out.ora") as f:
+        out = {name: f.read(entry) for name, entry in layer_sources(tmp_path / "out.ora").items()}
+        # png files are not compressed a second time
+        assert all(i.compress_type == zipfile.ZIP_STORED for i in f.infolist() if i.filename.endswith(".png"))
+    assert out["bottom"] == original["bottom"]
+    assert out["top"] != original["top"]
+    # layers that are not stored in the requested layer format are encoded again
+    with zipfile.ZipFile(tmp_path / "indexed.ora") as f:
+        for name, entry in layer_sources(tmp_path / "indexed.ora").items():
+            assert Image.open(io.BytesIO(f.read(entry))).mode == "P"
+            assert np.array_equal(read_ora(tmp_path / "indexed.ora")[name][0], read_ora(tmp_path / "in.ora")[name][0])
+
+
+def test_opacity_and_visibility_round_trip(tmp_path):
+    import xmltodict
+    mid = random_layer(30, 5, 4)
+    mid[..., 3] = 255
+    write_ora(tmp_path / "in.ora", [("top", random_layer(31, 8, 8), 0, 0, {"visibility": "hidden"}),
+                                    ("mid", mid, 2, 3, {"opacity": "0.5"}),
+                                    ("bottom", np.zeros((8, 8, 4), dtype=np.uint8), 0, 0)], 8, 8)
+    run_yaml(tmp_path, f"""
+- ora-tool:
+    input: {tmp_path / "in.ora"}
+    output: {tmp_path / "a.ora"}
+    ops: [{{flip-layers: {{layers: top}}}}]
+- ora-tool:
+    input: {tmp_path / "a.ora"}
+    output: {tmp_path / "b.ora"}
+    ops: [{{flip-layers: {{layers: mid}}}}]
+""")
+    for name in ["a.ora", "b.ora"]:
+        with zipfile.ZipFile(tmp_path / name) as f:
+            stack = xmltodict.parse(f.read("stack.xml"))["image"]["stack"]["layer"]
+            merged = np.asarray(Image.open(io.BytesIO(f.read("mergedimage.png"))).convert("RGBA"))
+        attributes = {x["@name"]: (float(x["@opacity"]), x["@visibility"]) for x in stack}
+        assert attributes == {"top": (1, "hidden"), "mid": (0.5, "visible"), "bottom": (1, "visible")}
+        # the hidden layer is left out of the merged image, the other one is
+        # blended with half its opacity
+        expected = np.zeros((8, 8, 4), dtype=np.uint8)
+        expected[3:8, 2:6] = mid if name == "a.ora" else mid[:, ::-1]
+        expected[3:8, 2:6, 3] = 128
+        assert np.array_equal(merged, expected)
+    assert read_ora(tmp_path / "b.ora")["mid"][1:] == (2, 3)
+
+
+def tile_loop(width, height, border, space, img, add):
+    """ the tile by tile spacing of older versions, which added or removed it """
+    step_x, step_y = width + 2*border + space, height + 2*border + space
+    if add:
+        tiles_x, tiles_y = img.shape[1] // width, img.shape[0] // height
+        out = np.zeros((tiles_y * step_y - space, tiles_x * step_x - space) + img.shape[2:], dtype=np.uint8)
+    else:
+        tiles_x, tiles_y = (img.shape[1] + space) // step_x, (img.shape[0] + space) // step_y
+        out = np.zeros((tiles_y * height, tiles_x * width) + img.shape[2:], dtype=np.uint8)
+    for y in range(tiles_y):
+        for x in range(tiles_x):
+            x0, y0 = x * width, y * height
+            x1, y1 = x * step_x + border, y * step_y + border
+            if not add:
+                out[y0:y0+height, x0:x0+width] = img[y1:y1+height, x1:x1+width]
+                continue
+            tile = img[y0:y0+height, x0:x0+width]
+            out[y1:y1+height, x1:x1+width] = tile
+            for b in range(1, border + 1):
+                out[y1-b, x1:x1+width] = tile[0]
+                out[y1+height+b-1, x1:x1+width] = tile[-1]
+                out[y1:y1+height, x1-b] = tile[:, 0]
+                out[y1:y1+height, x1+width+b-1] = tile[:, -1]
+            if border > 0:
+                out[y1-border:y1, x1-border:x1] = tile[0, 0]
+                out[y1+height:y1+height+border, x1-border:x1] = tile[-1, 0]
+                out[y1-border:y1, x1+width:x1+width+border] = tile[0, -1]
+                out[y1+height:y1+height+border, x1+width:x1+width+border] = tile[-1, -1]
+    return out
+
+
+@pytest.mark.parametrize("width, height, border, space", [(4, 3, 0, 0), (4, 3, 2, 1), (5, 5, 1, 3), (3, 4, 3, 0)])
+def test_tileset_spacing_like_tile_loop(tool, width, height, border, space):
+    # images that are not a whole number of tiles big
+    img = random_layer(32, 4 * height + 2, 5 * width + 1)
+    spaced = tool.add_tileset_spacing(width, height, border, space, img)
+    assert np.array_equal(spaced, tile_loop(width, height, border, space, img, True))
+    spaced = np.pad(spaced, ((0, 2), (0, 1), (0, 0)))
+    removed = tool.rm_tileset_spacing(width, height, border, space, spaced)
+    assert np.array_equal(removed, tile_loop(width, height, border, space, spaced, False))
+    assert np.array_equal(removed, img[:4 * height, :5 * width])
+
+
+def bleed_passes(img, threshold, full_neighborhood, iterations):
+    """
+        the neighborhood sums of older versions of fix-transparent-color,
+        repeated for the pixels set by each pass
+    """
+    h, w = img.shape[:2]
+    known = img[..., -1] > threshold
+    out = img * known[..., None]
+    sources, weights = known, img[..., -1].astype(np.uint64)
+    for _ in range(iterations):
+        weight = weights * sources
+        weighted = np.concatenate([out[..., :-1] * weight[..., None], weight[..., None]], axis=-1)
+        padded = np.pad(weighted, ((1, 1), (1, 1), (0, 0)))
+        sums = np.zeros_like(weighted)
+        for dy in [-1, 0, 1]:
+            for dx in [-1, 0, 1]:
+                if full_neighborhood or dx == 0 or dy == 0:
+                    sums += padded[1+dy:1+dy+h, 1+dx:1+dx+w]
+        bled = ~known & (sums[..., -1] > 0)
+        out[bled, :-1] = np.round(sums[bled, :-1] / sums[bled, -1:])
+        known |= bled
+        sources, weights = bled, np.ones_like(weights)
+    return out
+
+
+@pytest.mark.parametrize("threshold, full_neighborhood", [(0, True), (0, False), (100, True)])
+@pytest.mark.parametrize("iterations", [1, 4])
+def test_bleed_like_neighborhood_sums(tool, monkeypatch, threshold, full_neighborhood, iterations):
+    # strips of a few rows
+    monkeypatch.setattr(tool, "bleed_strip_pixels", 64)
+    rng = np.random.default_rng(33)
+    img = rng.integers(0, 256, (30, 20, 4), dtype=np.uint8)
+    img[..., 3] = np.where(rng.random((30, 20)) < .08, img[..., 3], 0)
+    expected = bleed_passes(img, threshold, full_neighborhood, iterations)
+    assert np.array_equal(tool.fix_transparent_color(img, threshold, full_neighborhood, iterations), expected)
+
+
+def test_layer_cache(tmp_path, tool, monkeypatch):
+    monkeypatch.setattr(tool, "layer_cache_usage", {})
+    layers = [(f"l{n}", random_layer(34 + n, 256, 256), 0, 0) for n in range(3)]
+    write_ora(tmp_path / "in.ora", layers, 256, 256)
+    cache = tmp_path / "cache" / "layers"
+    decoded = []
+    img_to_np = tool.img_to_np
+
+    def counted(f):
+        decoded.append(f)
+        return img_to_np(f)
+    monkeypatch.setattr(tool, "img_to_np", counted)
+
+    def load(order=range(3)):
+        doc = list(tool.load_ora(str(tmp_path / "in.ora"), str(tmp_path / "cache"), 1))
+        pixels = {doc[n].name: np.array(doc[n].pixels()) for n in order}
+        tool.close_ora_files()
+        return pixels
+    assert all(np.array_equal(load()[name], array) for name, array, _, _ in layers)
+    assert len(decoded) == 3
+    assert len(list(cache.iterdir())) == 3
+    # the second time the layers are read from the cache
+    assert all(np.array_equal(load()[name], array) for name, array, _, _ in layers)
+    assert len(decoded) == 3
+    # a changed layer has another CRC, so that its old pixels are not used;
+    # the four cached layers exceed 1 MB, so the least recently used is removed
+    layers[0] = ("l0", random_layer(37, 256, 256), 0, 0)
+    write_ora(tmp_path / "in.ora", layers, 256, 256)
+    for path in cache.iterdir():
+        os.utime(path, (1, 1))
+    assert all(np.array_equal(load([1, 2, 0])[name], array) for name, array, _, _ in layers)
+    assert len(decoded) == 4
+    assert len(list(cache.iterdir())) == 3
+    assert all(np.array_equal(load()[name], array) for name, array, _, _ in layers)
+    assert len(decoded) == 4